@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class Anderson():
+    def __init__(self, depth=5, restart=False, max_cond=1e10, positive=True):
+        """Anderson (DIIS) acceleration of a fixed point iteration x = g(x).
+        The next iterate mixes the last depth + 1 outputs of g so that the
+        same combination of their residuals g(x) - x is smallest. With
+        restart the history is cleared once it is full, otherwise the
+        oldest entry is dropped. The history is also cleared when the least
+        squares problem is worse conditioned than max_cond, or, if positive,
+        when the mixed iterate has negative entries, and the plain output of
+        g is used for that step """
+        self.depth = depth
+        self.restart = restart
+        self.max_cond = max_cond
+        self.positive = positive
+        self.restarts = 0
+        self.reset()
+
+    def reset(self):
+        self.prev_g = None
+        self.prev_f = None
+        self.dG = []
+        self.dF = []
+
+    def update(self, x, gx):
+        # Returns the next iterate from the latest input x and output g(x),
+        # gx is copied as it is kept in the history
+        gx = np.array(gx, dtype=np.float64)
+        f = gx - x
+        if self.prev_g is not None:
+            self.dG.append(gx - self.prev_g)
+            self.dF.append(f - self.prev_f)
+            if len(self.dF) > self.depth:
+                self.dG.pop(0)
+                self.dF.pop(0)
+        self.prev_g, self.prev_f = gx, f
+        if not self.dF:
+            return gx
+        dF = np.transpose(self.dF)
+        if np.linalg.cond(dF) > self.max_cond:
+            return self.fall_back(gx, f)
+        gamma = np.linalg.lstsq(dF, f, rcond=None)[0]
+        x_new = gx - np.transpose(self.dG) @ gamma
+        if self.positive and np.any(x_new < 0) and not np.any(gx < 0):
+            return self.fall_back(gx, f)
+        if self.restart and len(self.dF) == self.depth:
+            self.fall_back(gx, f)
+        return x_new
+
+    def fall_back(self, gx, f):
+        # Clears the history, keeping the latest output as its first entry
+        self.restarts += 1
+        self.reset()
+        self.prev_g, self.prev_f = gx, f
+        return gx
@@ -3,6 +3,8 @@ from typing import NamedTuple, Tuple
 
 import attr
 import numpy as np
+import scipy.sparse as sps
+import scipy.sparse.linalg as linalg
 import matplotlib.tri as tri
 
 from gallo import parse
@@ -29,6 +31,146 @@ def setup_ang_quad(sn_ord):
     return np.array(angs), np.array(weights)
 
 
+def find_opposite_angles(angs, tol=1e-12):
+    # Index of the direction opposite to each angle, -1 where the angular
+    # quadrature has no opposite direction
+    match = np.all(np.abs(angs[:, np.newaxis, :] + angs[np.newaxis, :, :]) < tol, axis=2)
+    opposite = np.full(len(angs), -1)
+    rows, cols = np.nonzero(match)
+    opposite[rows] = cols
+    return opposite
+
+
+# Quadrature rules on the standard triangle with vertices (0, 0), (1, 0) and
+# (0, 1). Points are (u, v) pairs and weights are normalized to sum to one so
+# that the integral over an element is area*(weights@f_values). Orders 2-4 are
+# the rules gallo has always used, orders 1, 5 and 6 are from Dunavant (1985).
+TRI_QUAD_RULES = {
+    1: ([[1/3, 1/3]],
+        [1]),
+    2: ([[0, 1/2], [1/2, 0], [1/2, 1/2]],
+        [1/3, 1/3, 1/3]),
+    3: ([[1/3, 1/3], [1/5, 1/5], [1/5, 3/5], [3/5, 1/5]],
+        [-27/48, 25/48, 25/48, 25/48]),
+    4: ([[0.44594849091597, 0.44594849091597],
+         [0.44594849091597, 0.10810301816807],
+         [0.10810301816807, 0.44594849091597],
+         [0.09157621350977, 0.09157621350977],
+         [0.09157621350977, 0.81684757298046],
+         [0.81684757298046, 0.09157621350977]],
+        [0.22338158967801, 0.22338158967801, 0.22338158967801,
+         0.10995174365532, 0.10995174365532, 0.10995174365532]),
+    5: ([[1/3, 1/3],
+         [0.470142064105115, 0.470142064105115],
+         [0.470142064105115, 0.059715871789770],
+         [0.059715871789770, 0.470142064105115],
+         [0.101286507323456, 0.101286507323456],
+         [0.101286507323456, 0.797426985353087],
+         [0.797426985353087, 0.101286507323456]],
+        [0.225,
+         0.132394152788506, 0.132394152788506, 0.132394152788506,
+         0.125939180544827, 0.125939180544827, 0.125939180544827]),
+    6: ([[0.249286745170910, 0.249286745170910],
+         [0.249286745170910, 0.501426509658179],
+         [0.501426509658179, 0.249286745170910],
+         [0.063089014491502, 0.063089014491502],
+         [0.063089014491502, 0.873821971016996],
+         [0.873821971016996, 0.063089014491502],
+         [0.310352451033784, 0.636502499121399],
+         [0.636502499121399, 0.053145049844817],
+         [0.053145049844817, 0.310352451033784],
+         [0.636502499121399, 0.310352451033784],
+         [0.310352451033784, 0.053145049844817],
+         [0.053145049844817, 0.636502499121399]],
+        [0.116786275726379, 0.116786275726379, 0.116786275726379,
+         0.050844906370207, 0.050844906370207, 0.050844906370207,
+         0.082851075618374, 0.082851075618374, 0.082851075618374,
+         0.082851075618374, 0.082851075618374, 0.082851075618374]),
+}
+
+
+class TriQuadrature():
+    def __init__(self, order):
+        if order not in TRI_QUAD_RULES:
+            raise RuntimeError("No triangle quadrature rule of order {}".format(order))
+        points, weights = TRI_QUAD_RULES[order]
+        self.order = order
+        self.points = np.array(points, dtype=float)
+        self.weights = np.array(weights, dtype=float)
+        self.num_points = len(self.weights)
+        # Values of the linear basis functions of local nodes 0, 1 and 2 at
+        # the quadrature points, shape (num_points, 3). The standard triangle
+        # is mapped so that local nodes 1, 2 and 0 sit at (0, 0), (1, 0) and
+        # (0, 1), which makes these the same on every element.
+        u, v = self.points[:, 0], self.points[:, 1]
+        self.shape_values = np.stack((v, 1 - u - v, u), axis=1)
+
+    @classmethod
+    def from_num_points(cls, num_points):
+        for order, (points, weights) in TRI_QUAD_RULES.items():
+            if len(weights) == num_points:
+                return cls(order)
+        raise RuntimeError("No triangle quadrature rule with {} points".format(num_points))
+
+    def integrate(self, area, f_values):
+        # Integrates values given at the quadrature points, the last axis of
+        # f_values runs over the points
+        return area * (np.asarray(f_values) @ self.weights)
+
+
+# Two point Gauss-Legendre rule on a boundary edge, given as the fraction of
+# the way along the edge from its first to its second vertex
+EDGE_QUAD_POINTS = np.array([1 - 1 / np.sqrt(3), 1 + 1 / np.sqrt(3)]) / 2
+# Values of the linear basis functions of the two edge vertices at the
+# edge quadrature points, shape (2, 2)
+EDGE_SHAPE_VALUES = np.stack((1 - EDGE_QUAD_POINTS, EDGE_QUAD_POINTS), axis=1)
+
+
+class BoundaryEdges(NamedTuple):
+    elts: np.ndarray           # element each edge belongs to, (num_edges,)
+    local_verts: np.ndarray    # local vertex numbers of the edge, (num_edges, 2)
+    nodes: np.ndarray          # global node ids of the edge, (num_edges, 2)
+    normals: np.ndarray        # outward unit normals, (num_edges, 2)
+    lengths: np.ndarray        # (num_edges,)
+    gauss_points: np.ndarray   # (num_edges, 2, 2)
+    gauss_weights: np.ndarray  # (num_edges, 2)
+
+    @property
+    def num_edges(self):
+        return len(self.lengths)
+
+
+class ElementOperator(linalg.LinearOperator):
+    def __init__(self, grid, local_matrices, boundary_local=None):
+        """Applies the sum of element matrices, and optionally boundary edge
+        matrices, to a vector without assembling a global matrix, so the
+        storage is O(num_elts). diagonal() gives the diagonal of the
+        assembled operator for Jacobi preconditioning """
+        super().__init__(np.float64, (grid.num_nodes, grid.num_nodes))
+        self.connectivity = grid.connectivity
+        self.boundary_nodes = grid.boundary.nodes
+        self.local_matrices = local_matrices
+        self.boundary_local = boundary_local
+
+    def scatter(self, nodes, values):
+        return np.bincount(nodes.ravel(), weights=values.ravel(), minlength=self.shape[0])
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        conn = self.connectivity
+        y = self.scatter(conn, np.einsum('enm,em->en', self.local_matrices, x[conn]))
+        if self.boundary_local is not None:
+            nodes = self.boundary_nodes
+            y += self.scatter(nodes, np.einsum('bij,bj->bi', self.boundary_local, x[nodes]))
+        return y
+
+    def diagonal(self):
+        diag = self.scatter(self.connectivity, np.diagonal(self.local_matrices, axis1=1, axis2=2))
+        if self.boundary_local is not None:
+            diag += self.scatter(self.boundary_nodes, np.diagonal(self.boundary_local, axis1=1, axis2=2))
+        return diag
+
+
 @attr.s(slots=True, frozen=True, auto_attribs=True, repr=False)
 class Element:
     el_id: int
@@ -52,12 +194,206 @@ class Node:
 
 class FEGrid():
     def __init__(self, node_file, ele_file, sn_ord=2, num_gauss_nodes=4):
+        elts_list = parse.parse_elts(ele_file)
+        nodes, extrema = parse.parse_nodes(node_file)
+        self.setup(nodes, elts_list, extrema, sn_ord, num_gauss_nodes)
+
+    @classmethod
+    def from_arrays(cls, coords, connectivity, mat_ids, is_boundary, sn_ord=2,
+                    num_gauss_nodes=4):
+        # Rebuilds a grid from its struct-of-arrays form, e.g. in a worker
+        # process that only has access to the shared mesh arrays
+        nodes = [Node((x, y), i, not bdy) for i, ((x, y), bdy)
+                 in enumerate(zip(np.asarray(coords).tolist(), np.asarray(is_boundary).tolist()))]
+        elts_list = [Element(e, tuple(vertices), mat_id) for e, (vertices, mat_id)
+                     in enumerate(zip(np.asarray(connectivity).tolist(), np.asarray(mat_ids).tolist()))]
+        extrema = (np.min(coords[:, 0]), np.max(coords[:, 0]),
+                   np.min(coords[:, 1]), np.max(coords[:, 1]))
+        grid = cls.__new__(cls)
+        grid.setup(nodes, elts_list, extrema, sn_ord, num_gauss_nodes)
+        return grid
+
+    def setup(self, nodes, elts_list, extrema, sn_ord, num_gauss_nodes):
+        self.sn_ord = sn_ord
         self.angs, self.weights = setup_ang_quad(sn_ord)
         self.num_angs = len(self.weights)
+        self.opposite_angs = find_opposite_angles(self.angs)
         self.num_gauss_nodes = num_gauss_nodes
-        self.elts_list = parse.parse_elts(ele_file)
-        self.nodes, extrema = parse.parse_nodes(node_file)
+        self.quad = TriQuadrature.from_num_points(num_gauss_nodes)
+        self.quad_rules = {self.quad.order: self.quad}
+        self.elts_list = elts_list
+        self.nodes = nodes
         self.xmin, self.xmax, self.ymin, self.ymax = extrema
+        self.setup_geometry()
+
+    def setup_geometry(self):
+        # Struct-of-arrays copy of the mesh so geometry can be computed in bulk
+        self.coords = np.array([node.position for node in self.nodes], dtype=float)
+        self.connectivity = np.array([elt.vertices for elt in self.elts_list], dtype=int)
+        self.mat_ids = np.array([elt.mat_id for elt in self.elts_list], dtype=int)
+        self.is_boundary = np.array([not node.is_interior for node in self.nodes], dtype=bool)
+        # Vertex positions of every element, shape (num_elts, 3, 2)
+        pos = self.coords[self.connectivity]
+        # Jacobian of the map from the standard triangle used by TriQuadrature,
+        # which puts local node 1 at the origin: columns are the edge vectors
+        # from local node 1 to local nodes 2 and 0
+        dx = pos[:, [2, 0], :] - pos[:, 1:2, :]
+        self.jacobians = np.transpose(dx, (0, 2, 1))
+        # WARNING: the following calculation is correct for triangles in 2D *only*.
+        det = dx[:, 0, 0] * dx[:, 1, 1] - dx[:, 1, 0] * dx[:, 0, 1]
+        self.areas = np.abs(det) / 2
+        self.centroids = np.sum(pos, axis=1) / 3
+        # Linear basis functions c1 + c2x + c3y, column n holds the
+        # coefficients of the basis function for local node n
+        vandermonde = np.ones((self.num_elts, 3, 3))
+        vandermonde[:, :, 1:] = pos
+        self.basis_coefs = np.linalg.inv(vandermonde)
+        # Basis functions are linear so their gradients are constant on each
+        # element, shape (num_elts, 3, 2)
+        self.basis_gradients = np.transpose(self.basis_coefs[:, 1:, :], (0, 2, 1))
+        # Quadrature points of every element, shape (num_elts, num_gauss_nodes, 2)
+        self.gauss_points = np.einsum('qn,end->eqd', self.quad.shape_values, pos)
+        # Quadrature weights scaled by element area, shape (num_elts, num_gauss_nodes)
+        self.gauss_weights = np.outer(self.areas, self.quad.weights)
+        self.interpolation_matrix = self.setup_interpolation()
+        self.boundary = self.setup_boundary()
+        self.setup_element_matrices()
+        self.setup_sparsity()
+        self.setup_material_matrices()
+        self.setup_load_matrices()
+
+    def setup_element_matrices(self):
+        # Geometry-only element matrices, shape (num_elts, 3, 3)
+        # Stiffness: integral of grad(b_i).grad(b_j), constant on each element
+        self.stiffness_elts = self.areas[:, np.newaxis, np.newaxis] * np.einsum(
+            'eid,ejd->eij', self.basis_gradients, self.basis_gradients)
+        # Mass: integral of b_i*b_j using the grid's quadrature rule
+        shape_values = self.quad.shape_values
+        shape_products = shape_values[:, :, np.newaxis] * shape_values[:, np.newaxis, :]
+        self.mass_elts = np.einsum('eq,qij->eij', self.gauss_weights, shape_products)
+        # Global row and column of every entry of the element matrices, used
+        # to scatter them into a sparse matrix in one shot
+        shape = (self.num_elts, 3, 3)
+        self.elt_rows = np.broadcast_to(self.connectivity[:, :, np.newaxis], shape).ravel()
+        self.elt_cols = np.broadcast_to(self.connectivity[:, np.newaxis, :], shape).ravel()
+
+    def setup_sparsity(self):
+        # The nonzero pattern of every operator on this grid depends only on
+        # the connectivity, so the CSR structure is built once and operators
+        # only fill in its data array
+        pattern = sps.coo_matrix((np.ones(len(self.elt_rows)), (self.elt_rows, self.elt_cols)),
+                                 shape=(self.num_nodes, self.num_nodes)).tocsr()
+        pattern.sort_indices()
+        self.csr_indptr = pattern.indptr
+        self.csr_indices = pattern.indices
+        self.nnz = pattern.nnz
+        # Position in the data array of every element matrix entry
+        self.elt_to_nnz = self.nnz_index(self.elt_rows, self.elt_cols)
+        # Position in the data array of every boundary edge matrix entry,
+        # boundary edges are element edges so they are already in the pattern
+        nodes = self.boundary.nodes
+        shape = (self.boundary.num_edges, 2, 2)
+        bdy_rows = np.broadcast_to(nodes[:, :, np.newaxis], shape).ravel()
+        bdy_cols = np.broadcast_to(nodes[:, np.newaxis, :], shape).ravel()
+        self.boundary_to_nnz = self.nnz_index(bdy_rows, bdy_cols)
+
+    def setup_material_matrices(self):
+        # Geometry-only stiffness and mass matrices restricted to each
+        # material, shape (num_mats, nnz), and the boundary mass matrix.
+        # Operators with piecewise constant coefficients are weighted sums
+        # of these
+        self.stiffness_data = self.material_data(self.stiffness_elts)
+        self.mass_data = self.material_data(self.mass_elts)
+        self.boundary_mass_data = self.boundary_data()
+        # Integrals of b_k*grad(b_n) per material for both directions, shape
+        # (2, num_mats, nnz), so that row n of G_d @ phi is the integral of
+        # phi*d(b_n)/dx_d. grad(b_n) is constant and b_k integrates to area/3
+        moments = (self.areas[:, np.newaxis, np.newaxis] / 3 * self.basis_gradients)[:, :, np.newaxis, :]
+        shape = (self.num_elts, 3, 3)
+        self.gradient_data = np.array([self.material_data(np.broadcast_to(moments[..., d], shape))
+                                       for d in range(2)])
+
+    def setup_load_matrices(self):
+        # Sparse (num_nodes, num_elts) operators mapping an element-wise
+        # constant source to its load vector: the integral of q*b_n, and the
+        # integrals of q*d(b_n)/dx_d for both directions
+        rows = self.connectivity.ravel()
+        cols = np.repeat(np.arange(self.num_elts), 3)
+        shape = (self.num_nodes, self.num_elts)
+        self.load_matrix = sps.csr_matrix((np.repeat(self.areas / 3, 3), (rows, cols)), shape=shape)
+        self.gradient_load = [sps.csr_matrix(((self.areas[:, np.newaxis]*self.basis_gradients[:, :, d]).ravel(),
+                                              (rows, cols)), shape=shape) for d in range(2)]
+
+    def material_data(self, local_matrices):
+        # Sums element matrices separately for every material, row m is the
+        # data array of the matrix restricted to the elements of material m
+        index = self.mat_ids[:, np.newaxis]*self.nnz + self.elt_to_nnz.reshape(self.num_elts, 9)
+        data = np.bincount(index.ravel(), weights=np.ravel(local_matrices),
+                           minlength=self.num_mats*self.nnz)
+        return data.reshape(self.num_mats, self.nnz)
+
+    def nnz_index(self, rows, cols):
+        # Index into the CSR data array of each (row, col) entry of the pattern
+        pattern_rows = np.repeat(np.arange(self.num_nodes, dtype=np.int64),
+                                 np.diff(self.csr_indptr))
+        pattern_keys = pattern_rows*self.num_nodes + self.csr_indices
+        keys = np.asarray(rows, dtype=np.int64)*self.num_nodes + cols
+        index = np.searchsorted(pattern_keys, keys)
+        if np.any(pattern_keys[np.minimum(index, self.nnz - 1)] != keys):
+            raise RuntimeError("Entries are not in the sparsity pattern of the grid")
+        return index
+
+    def element_data(self, local_matrices):
+        # Sums element matrices of shape (num_elts, 3, 3) into the data array
+        # of the grid's sparsity pattern
+        return np.bincount(self.elt_to_nnz, weights=np.ravel(local_matrices),
+                           minlength=self.nnz)
+
+    def sparse_matrix(self, data):
+        # CSR matrix with the grid's sparsity pattern, the index arrays are
+        # shared between every matrix and must not be modified
+        return sps.csr_matrix((data, self.csr_indices, self.csr_indptr),
+                              shape=(self.num_nodes, self.num_nodes))
+
+    def assemble(self, local_matrices):
+        # Sums element matrices of shape (num_elts, 3, 3) into a global CSR
+        # matrix, duplicate entries are added together
+        return self.sparse_matrix(self.element_data(local_matrices))
+
+    def setup_interpolation(self):
+        # Sparse operator mapping nodal values to the values at every element
+        # quadrature point, row e*num_gauss_nodes + q holds the basis values of
+        # element e at its quadrature point q
+        num_points = self.num_elts * self.quad.num_points
+        data = np.tile(self.quad.shape_values, (self.num_elts, 1))
+        rows = np.broadcast_to(np.arange(num_points)[:, np.newaxis], data.shape)
+        cols = np.repeat(self.connectivity, self.quad.num_points, axis=0)
+        return sps.csr_matrix((data.ravel(), (rows.ravel(), cols.ravel())),
+                              shape=(num_points, self.num_nodes))
+
+    def setup_boundary(self):
+        # Boundary edges are the element edges that belong to a single element
+        local_edges = np.array([[0, 1], [1, 2], [2, 0]])
+        edges = self.connectivity[:, local_edges].reshape(-1, 2)
+        _, inverse, counts = np.unique(np.sort(edges, axis=1), axis=0,
+                                       return_inverse=True, return_counts=True)
+        on_boundary = counts[np.ravel(inverse)] == 1
+        elts = np.repeat(np.arange(self.num_elts), 3)[on_boundary]
+        local_verts = np.tile(local_edges, (self.num_elts, 1))[on_boundary]
+        nodes = edges[on_boundary]
+        start, end = self.coords[nodes[:, 0]], self.coords[nodes[:, 1]]
+        tangents = end - start
+        lengths = np.sqrt(np.sum(tangents**2, axis=1))
+        normals = np.stack((tangents[:, 1], -tangents[:, 0]), axis=1) / lengths[:, np.newaxis]
+        # Flip normals that point towards the vertex opposite the edge
+        opposite = self.connectivity[elts, 3 - np.sum(local_verts, axis=1)]
+        inward = np.sum(normals*(self.coords[opposite] - start), axis=1) > 0
+        normals[inward] *= -1
+        gauss_points = np.einsum('qv,bvd->bqd', EDGE_SHAPE_VALUES,
+                                 np.stack((start, end), axis=1))
+        gauss_weights = np.outer(lengths / 2, np.ones(len(EDGE_QUAD_POINTS)))
+        return BoundaryEdges(elts, local_verts, nodes, normals, lengths,
+                             gauss_points, gauss_weights)
 
     @property
     def num_nodes(self):
@@ -67,8 +403,12 @@ class FEGrid():
     def num_elts(self):
         return len(self.elts_list)
 
+    @property
+    def num_mats(self):
+        return int(np.max(self.mat_ids)) + 1
+
     def is_corner(self, node_number):
-        x, y = self.node(node_number).position
+        x, y = self.coords[node_number]
         on_xboundary = (x == self.xmax or x == self.xmin)
         on_yboundary = (y == self.ymax or y == self.ymin)
         return on_xboundary and on_yboundary
@@ -93,27 +433,10 @@ class FEGrid():
 
     def gradient(self, elt_number, local_node_number):
         # WARNING: The following only works for 2D triangular elements
-        element = self.elts_list[elt_number].vertices
-        xbase = self.node(elt_number, local_node_number).position
-        dx = np.zeros((2, 2))
-        for ivert in range(2):
-            other_node_number = element[(local_node_number + ivert + 1) % 3]
-            dx[ivert] = self.nodes[other_node_number].position
-            dx[ivert] -= xbase
-        det = dx[0, 0] * dx[1, 1] - dx[1, 0] * dx[0, 1]
-        retval = np.zeros(2)
-        retval[0] = (-(dx[1, 1] - dx[0, 1]) / det)
-        retval[1] = ((dx[1, 0] - dx[0, 0]) / det)
-        return retval
+        return self.basis_gradients[elt_number, local_node_number]
 
     def basis(self, elt_number):
-        vandermonde = np.zeros((3, 3))
-        for i in range(3):
-            vandermonde[i, 0] = 1
-            vandermonde[i, 1] = self.node(elt_number, i).position[0]
-            vandermonde[i, 2] = self.node(elt_number, i).position[1]
-        coefficients = np.linalg.inv(vandermonde)
-        return coefficients
+        return self.basis_coefs[elt_number]
 
     def boundary_nonzero(self, current_vert, e):
         # returns the points on the boundary where the basis function is non zero
@@ -197,63 +520,28 @@ class FEGrid():
         return gauss_nodes
 
 
-    def gauss_nodes(self, elt_number, ord=3):
+    def quadrature(self, ord=None):
+        if ord is None:
+            return self.quad
+        if ord not in self.quad_rules:
+            self.quad_rules[ord] = TriQuadrature(ord)
+        return self.quad_rules[ord]
+
+    def gauss_nodes(self, elt_number, ord=None):
         # WARNING only works for 2D triangular elements
-        # http://math2.uncc.edu/~shaodeng/TEACHING/math5172/Lectures/Lect_15.PDF
         # Transform the nodes on the standard triangle to the given element
-        if ord==2:
-            num_gnodes = 3
-            std_nodes = np.array([[0, 1/2], [1/2, 0], [1/2, 1/2]])
-        if ord==3:
-            num_gnodes = 4
-            # Set Standard Nodes
-            std_nodes = np.array([[1/3, 1/3], [1/5, 1/5], [1/5, 3/5], [3/5, 1/5]])
-        elif ord==4:
-            num_gnodes = 6
-            std_nodes = np.array([[0.44594849091597, 0.44594849091597],
-                                  [0.44594849091597, 0.10810301816807],
-                                  [0.10810301816807, 0.44594849091597],
-                                  [0.09157621350977, 0.09157621350977],
-                                  [0.09157621350977, 0.81684757298046],
-                                  [0.81684757298046, 0.09157621350977]])
-        # Get nodes of element
-        el_nodes = [self.node(elt_number, i) for i in [1, 2, 0]]
-        pos = np.array([el_nodes[i].position for i in range(3)])
-        area = self.element_area(elt_number)
-        # Transformation Function
-        # x(u, v) = alpha + u(beta - alpha) + v(gamma - alpha)
-        trans_nodes = np.zeros((num_gnodes, 2))
-        for i in range(num_gnodes):
-            stdnode = std_nodes[i]
-            N = np.array([[1 - stdnode[0] - stdnode[1]], [stdnode[0]], [stdnode[1]]])
-            for j in range(2):
-                trans_nodes[i, j] = np.sum(np.array([pos[k, j]*N[k] for k in range(3)]))
-        return trans_nodes
+        if ord is None or ord == self.quad.order:
+            return self.gauss_points[elt_number]
+        shape_values = self.quadrature(ord).shape_values
+        return shape_values @ self.coords[self.connectivity[elt_number]]
 
     def element_area(self, elt_number):
-        e = self.elts_list[elt_number]
-        n = self.nodes[e.vertices[0]]
-        xbase = n.position
-        dx = np.zeros((2, 2))
-        for ivert in [1, 2]:
-            other_node_number = e.vertices[ivert]
-            dx[ivert - 1, :] = self.nodes[other_node_number].position
-            for idir in range(2):
-                dx[ivert - 1, idir] -= xbase[idir]
-        # WARNING: the following calculation is correct for triangles in 2D *only*.
-        area = np.abs(dx[0, 0] * dx[1, 1] - dx[1, 0] * dx[0, 1]) / 2
-        return area
-
-    def gauss_quad(self, elt_number, f_values, ord=3):
-        area = self.element_area(elt_number)
-        if ord==2:
-            integral = 1 / 3 * area * (np.sum(f_values))
-        elif ord==3:
-            integral = area*(-27/48*f_values[0]+25/48*np.sum(f_values[1:]))
-        elif ord==4:
-            integral = area*(0.22338158967801*np.sum(f_values[0:3])
-                          + 0.10995174365532*np.sum(f_values[3:]))
-        return integral
+        return self.areas[elt_number]
+
+    def gauss_quad(self, elt_number, f_values, ord=None):
+        if ord is None or ord == self.quad.order:
+            return self.gauss_weights[elt_number] @ f_values
+        return self.quadrature(ord).integrate(self.areas[elt_number], f_values)
 
     def gauss_quad1d(self, f_values, boundary_vertices, e):
         # Two point Gaussian Quadrature in one dimension
@@ -264,18 +552,7 @@ class FEGrid():
         return integral
 
     def centroid(self, elt_number):
-        e = self.elts_list[elt_number]
-        retval = np.zeros(2)
-        for i in range(2):
-            retval[i] = 0.0
-        for ivert in range(3):
-            n = self.nodes[e.vertices[ivert]]
-            x = n.position
-            for idir in range(2):
-                retval[idir] += x[idir]
-        for idir in range(2):
-            retval[idir] /= 3
-        return retval
+        return self.centroids[elt_number]
 
     def assign_normal(self, nid, bid):
         pos_n = self.node(nid).position
@@ -313,15 +590,55 @@ class FEGrid():
         g_vals = gn_vals * gns_vals
         return g_vals
 
+    def values_at_gauss_nodes(self, values):
+        # Interpolates nodal values to the quadrature points of every element.
+        # The last axis of values runs over nodes, leading axes (groups,
+        # angles) are kept, result (..., num_elts, num_gauss_nodes)
+        values = np.asarray(values)
+        lead_shape = values.shape[:-1]
+        flat = values.reshape(-1, self.num_nodes)
+        at_points = (self.interpolation_matrix @ flat.T).T
+        return at_points.reshape(lead_shape + (self.num_elts, self.quad.num_points))
+
+    def edge_values(self, values):
+        # Interpolates nodal values to the boundary edge quadrature points,
+        # the last axis of values runs over nodes, result (..., num_edges, 2)
+        values = np.asarray(values)
+        return values[..., self.boundary.nodes] @ EDGE_SHAPE_VALUES.T
+
+    def boundary_matrix(self, coefs=None):
+        # Assembles the boundary integrals of coef*b_i*b_j over every boundary
+        # edge. coefs is either one value per edge or the values at the edge
+        # quadrature points, shape (num_edges, 2)
+        return self.sparse_matrix(self.boundary_data(coefs))
+
+    def boundary_data(self, coefs=None):
+        # Same as boundary_matrix, returned as a data array of the grid's
+        # sparsity pattern
+        return np.bincount(self.boundary_to_nnz, weights=self.boundary_local(coefs).ravel(),
+                           minlength=self.nnz)
+
+    def boundary_local(self, coefs=None):
+        # Edge matrices of the boundary integrals of coef*b_i*b_j, shape
+        # (num_edges, 2, 2)
+        bdy = self.boundary
+        weights = bdy.gauss_weights
+        if coefs is not None:
+            coefs = np.asarray(coefs)
+            if coefs.ndim == 1:
+                coefs = coefs[:, np.newaxis]
+            weights = weights*coefs
+        shape_products = EDGE_SHAPE_VALUES[:, :, np.newaxis] * EDGE_SHAPE_VALUES[:, np.newaxis, :]
+        return np.einsum('bq,qij->bij', weights, shape_products)
+
+    def linear_operator(self, local_matrices, boundary_local=None):
+        # Matrix-free operator of element matrices, shape (num_elts, 3, 3),
+        # and boundary edge matrices, shape (num_edges, 2, 2)
+        return ElementOperator(self, local_matrices, boundary_local)
+
     def setup_triangulation(self):
-        x = np.zeros(self.num_nodes)
-        y = np.zeros(self.num_nodes)
-        positions = (self.node(i).position for i in range(self.num_nodes))
-        for i, pos in enumerate(positions):
-            x[i], y[i] = pos
-        # Setup triangles
-        triangles = np.array([self.element(i).vertices for i in range(self.num_elts)])
-        triang = tri.Triangulation(x, y, triangles=triangles)
+        x, y = self.coords[:, 0], self.coords[:, 1]
+        triang = tri.Triangulation(x, y, triangles=self.connectivity)
         return triang
 
     def phi_at_gauss_nodes(self, triang, phi_prev, g_nodes):
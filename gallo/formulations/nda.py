@@ -4,8 +4,39 @@ import scipy.sparse as sps
 import scipy.sparse.linalg as linalg
 
 from gallo.fe import *
+from gallo.helpers import Helper
+
+class AngularMoments():
+    def __init__(self, grid):
+        """Angular moments of psi needed by the NDA closure, accumulated one
+        angle at a time so the angular flux is never stored: the scalar flux
+        sum_m w_m psi_m, the nodal tensor sum_m w_m Omega Omega^T psi_m,
+        shape (num_nodes, 2, 2), and sum_m w_m |Omega.n| psi_m at the
+        boundary edge quadrature points, shape (num_edges, 2) """
+        self.fegrid = grid
+        self.phi = np.zeros(grid.num_nodes)
+        self.tensor = np.zeros((grid.num_nodes, 2, 2))
+        self.boundary = np.zeros((grid.boundary.num_edges, 2))
+
+    @classmethod
+    def from_psi(cls, grid, psi):
+        moments = cls(grid)
+        for m in range(grid.num_angs):
+            moments.add(grid.angs[m], grid.weights[m], psi[m])
+        return moments
+
+    def add(self, ang, weight, psi):
+        ang = np.asarray(ang)
+        self.phi += weight*psi
+        self.tensor += weight*np.outer(ang, ang)*psi[:, np.newaxis, np.newaxis]
+        ang_normal = np.abs(self.fegrid.boundary.normals @ ang)
+        self.boundary += weight*ang_normal[:, np.newaxis]*self.fegrid.edge_values(psi)
+
 
 class NDA():
+    # The drift term makes the low order operator nonsymmetric
+    symmetric = False
+
     def __init__(self, grid, mat_data):
         self.fegrid = grid
         self.mat_data = mat_data
@@ -16,161 +47,60 @@ class NDA():
         self.angs = self.fegrid.angs
         self.weights = self.fegrid.weights
         self.num_gnodes = self.fegrid.num_gauss_nodes
+        self.helper = Helper(grid, mat_data)
 
     def make_lhs(self, group_id, ho_sols):
-        sparse_matrix = sps.lil_matrix((self.num_nodes, self.num_nodes))
-        # Solve higher order equation
-        if ho_sols !=0:
-            phi = np.array([ho_sols[0]])
-            psi = np.array([ho_sols[1]])
-        # Interpolate Phi
-        triang = self.fegrid.setup_triangulation()
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            # Determine material index of element
-            midx = elt.mat_id
-            # Get Diffusion coefficient for material
-            D = self.mat_data.get_diff(midx, group_id)
-            # Get removal cross section
-            sig_r = self.mat_data.get_sigr(midx, group_id)
-            inv_sigt = self.mat_data.get_inv_sigt(midx, group_id)
-            # Determine basis functions for element
-            coef = self.fegrid.basis(e)
-            # Determine Gauss Nodes for element
-            g_nodes = self.fegrid.gauss_nodes(e)
-            if ho_sols !=0:
-                # Find Phi at Gauss Nodes
-                phi_vals = self.fegrid.phi_at_gauss_nodes(triang, phi, g_nodes)
-                # Find Psi at Gauss Nodes
-                psi_vals = np.array([self.fegrid.phi_at_gauss_nodes(triang, psi[:, i], g_nodes) for i in range(4)])
-            for n in range(3):
-                # Get global node
-                n_global = self.fegrid.node(e, n)
-                # Get node IDs
-                nid = n_global.id
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(bn, g_nodes[i])
-                    for i in range(self.num_gnodes)])
-                for ns in range(3):
-                    # Get global node
-                    ns_global = self.fegrid.node(e, ns)
-                    nsid = ns_global.id
-                    # Coefficients of basis function
-                    bns = coef[:, ns]
-                    # Array of values of basis function evaluated at gauss nodes
-                    fns_vals = np.array([self.fegrid.evaluate_basis_function(bns, g_nodes[i])
-                        for i in range(self.num_gnodes)])
-                    # Calculate gradients
-                    grad = np.array([self.fegrid.gradient(e, i) for i in [n, ns]])
-                    # Integrate for A (basis function derivatives)
-                    area = self.fegrid.element_area(e)
-                    inprod = np.dot(grad[0], grad[1])
-                    A = D * area * inprod
-
-                    # Multiply basis functions together
-                    f_vals = fn_vals * fns_vals
-
-                    # Integrate for B (basis functions multiplied)
-                    basis_integral = self.fegrid.gauss_quad(e, f_vals)
-                    C = sig_r * basis_integral
+        # Diffusion and removal terms are linear combinations of the grid's
+        # per-material stiffness and mass matrices
+        num_mats = self.fegrid.num_mats
+        D = self.mat_data.D[:num_mats, group_id]
+        sig_r = self.mat_data.sig_r[:num_mats, group_id]
+        data = D @ self.fegrid.stiffness_data + sig_r @ self.fegrid.mass_data
+        if ho_sols == 0:
+            return self.fegrid.sparse_matrix(data)
+        # Closure from the angular moments of the higher order solution
+        tensor = self.drift_tensor(ho_sols)
+        # Drift term, integrated for every element in one pass
+        midx = self.fegrid.mat_ids
+        drift_vectors = self.compute_drift_vectors(self.mat_data.inv_sigt[midx, group_id],
+                                                   self.mat_data.D[midx, group_id], tensor)
+        data += self.fegrid.element_data(self.drift_matrices(drift_vectors))
+        # Boundary terms weighted by kappa, assembled over the
+        # precomputed boundary edges
+        data += self.fegrid.boundary_data(self.compute_kappas(ho_sols))
+        return self.fegrid.sparse_matrix(data)
 
-                    # Calculate drift_vector
-                    if ho_sols == 0:
-                        drift_vector = np.zeros((3, 2))
-                    else:
-                        drift_vector = self.compute_drift_vector(inv_sigt, D, grad[0], phi_vals[0], psi_vals[:, 0])
+    def make_rhs(self, group_id, source, phi_prev):
+        return self.helper.make_rhs(group_id, source, phi_prev)
 
-                    # Integrate drift_vector@gradient*basis_function
-                    drift_product = np.array([drift_vector[i]*fn_vals[i] for i in range(3)])
-                    integral = self.fegrid.gauss_quad(e, drift_product@grad[1])
-                    E = integral
+    def drift_tensor(self, moments):
+        # The tensor sum_m w_m Omega Omega^T psi_m / phi at the quadrature
+        # points of every element, shape (num_elts, num_gauss_nodes, 2, 2).
+        # Both moments are linear in psi, so interpolating them is the same
+        # as interpolating psi angle by angle
+        phi = self.fegrid.values_at_gauss_nodes(moments.phi)
+        tensor = self.fegrid.values_at_gauss_nodes(moments.tensor.reshape(-1, 4).T)
+        return np.moveaxis(tensor, 0, -1).reshape(phi.shape + (2, 2)) / phi[..., np.newaxis, np.newaxis]
 
-                    sparse_matrix[nid, nsid] += A + C + E
-                    # Check if boundary nodes
-                    if not n_global.is_interior and not ns_global.is_interior:
-                        # Assign boundary id, marks end of region along
-                        # boundary where basis function is nonzero
-                        bid = nsid
-                        # Figure out what boundary you're on
-                        if (nid == nsid) and (self.fegrid.is_corner(nid)):
-                            # If on a corner, figure out what normal we should use
-                            verts = self.fegrid.boundary_nonzero(nid, e)
-                            if verts == -1:  # Means the whole element is a corner
-                                # We have to calculate boundary integral twice,
-                                # once for each other vertex
-                                # Find the other vertices
-                                all_verts = np.array(self.fegrid.element(e).vertices)
-                                vert_local_idx = np.where(all_verts == nid)[0][0]
-                                other_verts = np.delete(all_verts, vert_local_idx)
-                                # Calculate boundary integrals for other vertices
-                                for vtx in other_verts:
-                                    bid = vtx
-                                    if ho_sols != 0:
-                                        normal = self.fegrid.assign_normal(nid, bid)
-                                        xis = self.fegrid.gauss_nodes1d([nid, bid], e)
-                                        phi_bd = self.fegrid.phi_at_gauss_nodes(triang, phi, xis)
-                                        psi_bd = np.array([self.fegrid.phi_at_gauss_nodes(triang, psi[:, i], xis) for i in range(4)])
-                                        basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                                        kappa = self.compute_kappa(normal, phi_bd[0], psi_bd[:, 0])
-                                        boundary_integral = self.fegrid.gauss_quad1d(kappa*basis_product, [nid, bid], e)
-                                        sparse_matrix[nid,nsid] += boundary_integral
-                                continue
-                            else:
-                                bid = verts[1]
-                        normal = self.fegrid.assign_normal(nid, bid)
-                        if isinstance(normal, int):
-                            continue
-                        if ho_sols != 0:
-                            # Get Gauss Nodes for the element
-                            xis = self.fegrid.gauss_nodes1d([nid, bid], e)
-                            phi_bd = self.fegrid.phi_at_gauss_nodes(triang, phi, xis)
-                            psi_bd = np.array([self.fegrid.phi_at_gauss_nodes(triang, psi[:, i], xis) for i in range(4)])
-                            basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                            kappa = self.compute_kappa(normal, phi_bd[0], psi_bd[:, 0])
-                            boundary_integral = self.fegrid.gauss_quad1d(kappa*basis_product, [nid, bid], e)
-                            sparse_matrix[nid, nsid] += boundary_integral
-        return sparse_matrix
+    def compute_drift_vectors(self, inv_sigt, D, tensor):
+        # Drift vectors of every element, quadrature point and local basis
+        # function, shape (num_elts, num_gauss_nodes, 3, 2), from the element
+        # cross sections and the closure tensor at the quadrature points
+        grads = self.fegrid.basis_gradients
+        streaming = np.einsum('eqij,enj->eqni', tensor, grads)
+        return (inv_sigt[:, np.newaxis, np.newaxis, np.newaxis] * streaming
+                - D[:, np.newaxis, np.newaxis, np.newaxis] * grads[:, np.newaxis, :, :])
 
-    def make_rhs(self, group_id, source, phi_prev):
-        rhs_at_node = np.zeros(self.num_nodes)
-        # Interpolate Phi
-        triang = self.fegrid.setup_triangulation()
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            midx = elt.mat_id
-            # Determine basis functions for element
-            coef = self.fegrid.basis(e)
-            # Determine Gauss Nodes for element
-            g_nodes = self.fegrid.gauss_nodes(e)
-            for n in range(3):
-                n_global = self.fegrid.node(e, n)
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at interior gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(
-                        bn, g_nodes[i]) for i in range(self.num_gnodes)])
-                # Get node ids
-                nid = n_global.id
-                area = self.fegrid.element_area(e)
-                # Find Phi at Gauss Nodes
-                phi_vals = self.fegrid.phi_at_gauss_nodes(triang, phi_prev, g_nodes)
-                # Multiply Phi & Basis Function
-                product = fn_vals * phi_vals
-                integral_product = np.array([self.fegrid.gauss_quad(e, product[g]) for g in range(self.num_groups)])
-                ssource = self.compute_scattering_source(midx, integral_product, group_id)
-                rhs_at_node[nid] += ssource
-                rhs_at_node[nid] += area*source[group_id, e]*1/3
-        return rhs_at_node
+    def drift_matrices(self, drift_vectors):
+        # Element matrices of the integrals of (drift_vector_i@grad(b_j))*b_i,
+        # with every point of the grid's quadrature rule
+        return np.einsum('eq,qn,eqnd,emd->enm', self.fegrid.gauss_weights,
+                         self.fegrid.quad.shape_values, drift_vectors,
+                         self.fegrid.basis_gradients)
 
-    def compute_scattering_source(self, midx, phi, group_id):
-        scatmat = self.mat_data.get_sigs(midx)
-        ssource = 0
-        for g_prime in range(self.num_groups):
-            if g_prime != group_id:
-                ssource += scatmat[g_prime, group_id]*phi[g_prime]
-        return ssource
+    def compute_kappas(self, moments):
+        # Kappa at both quadrature points of every boundary edge
+        return moments.boundary / self.fegrid.edge_values(moments.phi)
 
     def compute_kappa(self, normal, phi, psi):
         kappa = np.zeros(2)
@@ -5,7 +5,11 @@ import scipy.sparse as sps
 import scipy.sparse.linalg as linalg
 import matplotlib.tri as tri
 
+from gallo.helpers import Helper
+
 class SAAF():
+    symmetric = True
+
     def __init__(self, grid, mat_data):
         self.fegrid = grid
         self.mat_data = mat_data
@@ -17,142 +21,114 @@ class SAAF():
         self.num_nodes = self.fegrid.num_nodes
         self.num_elts = self.fegrid.num_elts
         self.num_gnodes = self.fegrid.num_gauss_nodes
+        self.streaming_data = self.setup_streaming()
+        self.group_cache = {}
+        self.helper = Helper(grid, mat_data)
+        self.scattering_cache = {}
+
+    def setup_streaming(self):
+        # The streaming term (angles@grad(b_i))*(angles@grad(b_j)) is bilinear
+        # in the angle, so it is split into the direction tensor components
+        # xx, xy (symmetrized) and yy, each assembled per material,
+        # shape (3, num_mats, nnz)
+        grads = self.fegrid.basis_gradients
+        gx, gy = grads[:, :, 0], grads[:, :, 1]
+        area = self.fegrid.areas[:, np.newaxis, np.newaxis]
+        xx = area * gx[:, :, np.newaxis] * gx[:, np.newaxis, :]
+        xy = area * (gx[:, :, np.newaxis] * gy[:, np.newaxis, :]
+                     + gy[:, :, np.newaxis] * gx[:, np.newaxis, :]) / 2
+        yy = area * gy[:, :, np.newaxis] * gy[:, np.newaxis, :]
+        return np.array([self.fegrid.material_data(k) for k in (xx, xy, yy)])
+
+    def group_data(self, group_id):
+        # Angle independent pieces of the group operator: the streaming tensor
+        # components scaled by 1/sig_t, shape (3, nnz), and the sig_t weighted
+        # mass matrix, shape (nnz,). Computed once per group
+        if group_id not in self.group_cache:
+            num_mats = self.fegrid.num_mats
+            inv_sigt = self.mat_data.inv_sigt[:num_mats, group_id]
+            sig_t = self.mat_data.sig_t[:num_mats, group_id]
+            streaming = np.einsum('m,kmn->kn', inv_sigt, self.streaming_data)
+            mass = sig_t @ self.fegrid.mass_data
+            self.group_cache[group_id] = (streaming, mass)
+        return self.group_cache[group_id]
 
     def make_lhs(self, angles, group_id):
-        sparse_matrix = sps.lil_matrix((self.num_nodes, self.num_nodes))
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            # Determine material index of element
-            midx = elt.mat_id
-            # Get sigt and precomputed inverse
-            inv_sigt = self.mat_data.get_inv_sigt(midx, group_id)
-            sig_t = self.mat_data.get_sigt(midx, group_id)
-            # Determine basis functions for element
-            coef = self.fegrid.basis(e)
-            # Determine Gauss Nodes for element
-            g_nodes = self.fegrid.gauss_nodes(e)
-            for n in range(3):
-                # Get global node
-                n_global = self.fegrid.node(e, n)
-                # Get global node id
-                nid = n_global.id
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(bn, g_nodes[i])
-                    for i in range(self.num_gnodes)])
-                for ns in range(3):
-                    # Get global node
-                    ns_global = self.fegrid.node(e, ns)
-                    # Get node IDs
-                    nsid = ns_global.id
-                    # Coefficients of basis function
-                    bns = coef[:, ns]
-                    # Array of values of basis function evaluated at gauss nodes
-                    fns_vals = np.array([self.fegrid.evaluate_basis_function(bns, g_nodes[i])
-                        for i in range(self.num_gnodes)])
-                    # Calculate gradients
-                    grad = np.array([self.fegrid.gradient(e, i) for i in [n, ns]])
-                    # Multiply basis functions together at the gauss nodes
-                    f_vals = fn_vals * fns_vals
-                    # Integrate for A (basis function derivatives)
-                    area = self.fegrid.element_area(e)
-                    A = inv_sigt * (angles @ grad[0]) * (angles @ grad[1]) * area
-                    # Integrate for B (basis functions multiplied)
-                    integral = self.fegrid.gauss_quad(e, f_vals)
-                    C = sig_t * integral
-                    sparse_matrix[nid, nsid] += A + C
-                    # Check if boundary nodes
-                    if not n_global.is_interior and not ns_global.is_interior:
-                        # Assign boundary id, marks end of region along
-                        # boundary where basis function is nonzero
-                        bid = nsid
-                        # Figure out what boundary you're on
-                        if (nid == nsid) and (self.fegrid.is_corner(nid)):
-                            # If on a corner, figure out what normal we should use
-                            verts = self.fegrid.boundary_nonzero(nid, e)
-                            if verts == -1:  # Means the whole element is a corner
-                                # We have to calculate boundary integral twice,
-                                # once for each other vertex
-                                # Find the other vertices
-                                all_verts = np.array(self.fegrid.element(e).vertices)
-                                vert_local_idx = np.where(all_verts == nid)[0][0]
-                                other_verts = np.delete(all_verts, vert_local_idx)
-                                # Calculate boundary integrals for other vertices
-                                for vtx in other_verts:
-                                    bid = vtx
-                                    normal = self.fegrid.assign_normal(nid, bid)
-                                    if angles @ normal > 0:
-                                        xis = self.fegrid.gauss_nodes1d(
-                                            [nid, bid], e)
-                                        basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                                        boundary_integral = self.fegrid.gauss_quad1d(basis_product, [nid, bid], e)
-                                        sparse_matrix[nid, nsid] += angles @ normal * boundary_integral
-                                continue
-                            else:
-                                bid = verts[1]
-                        normal = self.fegrid.assign_normal(nid, bid)
-                        if isinstance(normal, int):
-                            continue
-                        if angles @ normal > 0:
-                            # Get Gauss Nodes for the element
-                            xis = self.fegrid.gauss_nodes1d([nid, bid], e)
-                            basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                            boundary_integral = self.fegrid.gauss_quad1d(basis_product, [nid, bid], e)
-                            sparse_matrix[nid, nsid] += angles @ normal * boundary_integral
-                        else:
-                            pass
-        return sparse_matrix
+        data = self.volume_data(angles, group_id) + self.outflow_data(angles)
+        return self.fegrid.sparse_matrix(data)
+
+    def make_lhs_pair(self, angles, group_id):
+        # Operators for angles and -angles. The volume terms are even in the
+        # angle so they are formed once, only the outflow boundary differs
+        volume = self.volume_data(angles, group_id)
+        return (self.fegrid.sparse_matrix(volume + self.outflow_data(angles)),
+                self.fegrid.sparse_matrix(volume + self.outflow_data(-angles)))
+
+    def lhs_operator(self, angles, group_id):
+        # Matrix-free operator for angles, the element matrices are formed
+        # from the element geometry and cross sections
+        midx = self.fegrid.mat_ids
+        inv_sigt = self.mat_data.inv_sigt[midx, group_id]
+        sig_t = self.mat_data.sig_t[midx, group_id]
+        ang_grads = self.fegrid.basis_gradients @ angles
+        local = ((inv_sigt*self.fegrid.areas)[:, np.newaxis, np.newaxis]
+                 * ang_grads[:, :, np.newaxis] * ang_grads[:, np.newaxis, :]
+                 + sig_t[:, np.newaxis, np.newaxis]*self.fegrid.mass_elts)
+        ang_normal = self.fegrid.boundary.normals @ angles
+        return self.fegrid.linear_operator(local, self.fegrid.boundary_local(np.maximum(ang_normal, 0)))
+
+    def volume_data(self, angles, group_id):
+        streaming, mass = self.group_data(group_id)
+        # Streaming term for this angle from the direction tensor components
+        ox, oy = angles
+        return np.array([ox*ox, 2*ox*oy, oy*oy]) @ streaming + mass
+
+    def outflow_data(self, angles):
+        # Outflow boundary terms, only edges with angles@normal > 0 contribute
+        ang_normal = self.fegrid.boundary.normals @ angles
+        return self.fegrid.boundary_data(np.maximum(ang_normal, 0))
 
     def make_rhs(self, group_id, source, angles, angle_id, phi_prev=None):
-        angles = np.array(angles)
-        rhs_at_node = np.zeros(self.num_nodes)
-        # Interpolate Phi
-        triang = self.fegrid.setup_triangulation()
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            midx = elt.mat_id
-            inv_sigt = self.mat_data.get_inv_sigt(midx, group_id)
-            # Determine basis functions for element
-            coef = self.fegrid.basis(e)
-            # Determine Gauss Nodes for element
-            g_nodes = self.fegrid.gauss_nodes(e)
-            for n in range(3):
-                n_global = self.fegrid.node(e, n)
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at interior gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(bn, g_nodes[i])
-                    for i in range(self.num_gnodes)])
-                # Get node ids
-                nid = n_global.id
-                ngrad = self.fegrid.gradient(e, n)
-                area = self.fegrid.element_area(e)
-                # Find Phi at Gauss Nodes
-                phi_vals = self.fegrid.phi_at_gauss_nodes(triang, phi_prev, g_nodes)
-                # First Scattering Term
-                # Multiply Phi & Basis Function
-                product = fn_vals * phi_vals
-                integral_product = np.array([self.fegrid.gauss_quad(e, product[g])
-                                            for g in range(self.num_groups)])
-                ssource = self.compute_scattering_source(
-                    midx, integral_product, group_id)
-                rhs_at_node[nid] += ssource / (4 * np.pi)
-                # Second Scattering Term
-                integral = np.array([self.fegrid.gauss_quad(e, phi_vals[g]*(angles@ngrad))
-                                    for g in range(self.num_groups)])
-                ssource = self.compute_scattering_source(
-                    midx, integral, group_id)
-                rhs_at_node[nid] += inv_sigt*ssource/(4*np.pi)
-                q_fixed = source[group_id, e] / (4 * np.pi)
-                rhs_at_node[nid] += q_fixed * (area / 3)
-                # Second Fixed Source Term
-                rhs_at_node[nid] += inv_sigt*q_fixed*(angles@ngrad)*area
-        return rhs_at_node
+        isotropic, directional = self.make_rhs_parts(group_id, source, angles, phi_prev)
+        return isotropic + directional
+
+    def make_rhs_all(self, group_id, source, phi_prev=None, angles=None):
+        # Right hand sides of every angle of the quadrature (or of the given
+        # angles) at once, shape (num_angs, num_nodes). The isotropic part is
+        # shared and the odd part is one (num_angs, 2) by (2, num_nodes) product
+        if angles is None:
+            angles = self.fegrid.angs
+        isotropic, moments = self.source_moments(group_id, source, phi_prev)
+        return isotropic + np.array(angles) @ moments
+
+    def make_rhs_parts(self, group_id, source, angles, phi_prev=None):
+        # Splits the right hand side into the isotropic source terms and the
+        # terms that are odd in the angle
+        isotropic, moments = self.source_moments(group_id, source, phi_prev)
+        return isotropic, np.array(angles) @ moments
 
-    def compute_scattering_source(self, midx, phi, group_id):
-        scatmat = self.mat_data.get_sigs(midx)
-        ssource = 0
-        for g_prime in range(self.num_groups):
-            ssource += scatmat[g_prime, group_id]*phi[g_prime]
-        return ssource
+    def source_moments(self, group_id, source, phi_prev):
+        # Isotropic part of the right hand side, shape (num_nodes,), and the
+        # x and y moments of the part that is odd in the angle, shape
+        # (2, num_nodes), so the right hand side is isotropic + angles@moments
+        if group_id not in self.scattering_cache:
+            helper = self.helper
+            num_mats = self.fegrid.num_mats
+            inv_sigt = self.mat_data.inv_sigt[:num_mats, group_id]
+            # Scattering from every group including self-scatter
+            isotropic = helper.scattering_matrices(group_id, self_scatter=True)
+            gradient = [helper.scattering_matrices(group_id, self.fegrid.gradient_data[d],
+                                                   inv_sigt, self_scatter=True)
+                        for d in range(2)]
+            self.scattering_cache[group_id] = (isotropic, gradient)
+        isotropic, gradient = self.scattering_cache[group_id]
+        q_fixed = source[group_id] / (4 * np.pi)
+        # First Scattering Term and Fixed Source Term
+        rhs_iso = self.helper.scattering_source(isotropic, phi_prev) / (4 * np.pi)
+        rhs_iso += self.fegrid.load_matrix @ q_fixed
+        # Second Scattering Term and Second Fixed Source Term
+        inv_sigt = self.mat_data.inv_sigt[self.fegrid.mat_ids, group_id]
+        moments = np.array([self.helper.scattering_source(gradient[d], phi_prev) / (4 * np.pi)
+                            + self.fegrid.gradient_load[d] @ (inv_sigt*q_fixed)
+                            for d in range(2)])
+        return rhs_iso, moments
@@ -6,37 +6,55 @@ class Helper():
         self.mat_data = mat_data
         self.num_groups = self.mat_data.get_num_groups()
         self.num_elts = self.fegrid.num_elts
+        self.scattering_cache = {}
 
     def flux_at_elt(self, flux):
         """ Takes in fluxes at nodes and returns averaged fluxes for each element. """
-        num_groups = np.shape(flux)[0]
-        elt_flux = np.zeros((num_groups, self.num_elts))
-        for g in range(num_groups):
-            for ele in range(self.num_elts):
-                vertices = self.fegrid.element(ele).vertices
-                func = 0
-                for vtx in vertices:
-                    func += flux[g, vtx]
-                func /= 3
-                elt_flux[g, ele] = func
-        return elt_flux
+        return np.sum(flux[:, self.fegrid.connectivity], axis=2) / 3
 
     def integrate_flux(self, flux):
         # Integrate Flux Over Total Domain
-        areas = np.array([self.fegrid.element_area(ele) for ele in range(self.num_elts)])
-        #elt_fluxes = self.flux_at_elt(flux)
-        return np.sum(areas*flux)
+        return np.sum(self.fegrid.areas*flux)
 
     def make_full_fission_source(self, phi):
-        fiss_source = np.zeros((self.num_groups, self.num_elts))
         flux_at_elt = self.flux_at_elt(phi)
-        for group in range(self.num_groups):
-            for elt in range(self.num_elts):
-                midx = self.fegrid.element(elt).mat_id
-                phi = flux_at_elt[:, elt]
-                fiss_source[group, elt] = self.compute_fission_source(midx, phi, group)
+        midx = self.fegrid.mat_ids
+        # nu*sigf for every group of every element, shape (num_groups, num_elts)
+        nu_sigf = np.transpose(self.mat_data.nu[midx] * self.mat_data.sig_f[midx])
+        fiss_source = np.transpose(self.mat_data.chi[midx]) * np.sum(nu_sigf*flux_at_elt, axis=0)
         return fiss_source
 
+    def scattering_matrices(self, group_id, material_data=None, weights=None, self_scatter=False):
+        """ Sparse operators S[g'] = sum_m weights[m]*sig_s[m, g', group_id]*M_m, where
+        M_m is the mass matrix of material m (or the given per-material data), so the
+        scattering source into group_id is sum over g' of S[g'] @ phi[g']. """
+        if material_data is None:
+            material_data = self.fegrid.mass_data
+        num_mats = self.fegrid.num_mats
+        sig_s = np.array(self.mat_data.sig_s[:num_mats, :, group_id])
+        if not self_scatter:
+            sig_s[:, group_id] = 0
+        if weights is not None:
+            sig_s *= weights[:, np.newaxis]
+        return [self.fegrid.sparse_matrix(data) for data in sig_s.T @ material_data]
+
+    def scattering_source(self, matrices, phi):
+        # One sparse mat-vec per group
+        ssource = np.zeros(self.fegrid.num_nodes)
+        for g_prime, matrix in enumerate(matrices):
+            ssource += matrix @ phi[g_prime]
+        return ssource
+
+    def make_rhs(self, group_id, source, phi_prev):
+        """ Nodal right hand side of the scalar flux equations: scattering from the
+        other groups plus the fixed source, with the scattering operators built
+        once per group. """
+        if group_id not in self.scattering_cache:
+            self.scattering_cache[group_id] = self.scattering_matrices(group_id)
+        rhs_at_node = self.scattering_source(self.scattering_cache[group_id], phi_prev)
+        rhs_at_node += self.fegrid.load_matrix @ source[group_id]
+        return rhs_at_node
+
     def compute_scattering_source(self, midx, phi, group_id):
         scatmat = self.mat_data.get_sigs(midx)
         ssource = 0
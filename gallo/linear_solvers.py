@@ -0,0 +1,203 @@
+from collections import OrderedDict
+import inspect
+
+import numpy as np
+import scipy.sparse as sps
+import scipy.sparse.linalg as linalg
+import scipy.linalg as dense_linalg
+
+# Largest system solved with a sparse direct method when the method is 'auto'
+DIRECT_MAX_NODES = 50000
+
+# Default memory budget of the factorization cache, in bytes
+CACHE_BYTES = 256 * 2**20
+
+METHODS = ['auto', 'direct', 'splu', 'dense', 'cg', 'gmres', 'bicgstab']
+DIRECT_METHODS = ['direct', 'splu', 'dense']
+PRECONDITIONERS = [None, 'jacobi']
+ITERATIVE_METHODS = {'cg': linalg.cg, 'gmres': linalg.gmres, 'bicgstab': linalg.bicgstab}
+
+
+def krylov_kwargs(solver, tol):
+    # Tolerance keywords of a scipy Krylov solver. SciPy 1.12 renamed tol to
+    # rtol, and gmres gained callback_type, whose 'pr_norm' is the residual
+    # norm older releases always pass to the callback
+    params = inspect.signature(solver).parameters
+    kwargs = {'rtol' if 'rtol' in params else 'tol': tol, 'atol': 0}
+    if 'callback_type' in params:
+        kwargs['callback_type'] = 'pr_norm'
+    return kwargs
+
+
+class LinearSolver():
+    def __init__(self, method='auto', tol=1e-10, max_iter=None,
+                 direct_max_nodes=DIRECT_MAX_NODES, preconditioner=None):
+        """Solves the sparse systems assembled by the formulations. method is
+        one of 'direct' (spsolve), 'splu', 'dense' (scipy.linalg.solve),
+        'cg', 'gmres', 'bicgstab' or 'auto', which uses a direct solve for
+        systems up to direct_max_nodes unknowns and otherwise CG for
+        symmetric and GMRES for nonsymmetric systems. Matrix-free operators
+        are always solved iteratively. preconditioner is None or 'jacobi' """
+        if method not in METHODS:
+            raise RuntimeError("Linear solver method " + str(method) + " not supported, "
+                               "choose from " + ", ".join(METHODS))
+        if preconditioner not in PRECONDITIONERS:
+            raise RuntimeError("Preconditioner " + str(preconditioner) + " not supported")
+        self.method = method
+        self.preconditioner = preconditioner
+        self.tol = tol
+        self.max_iter = max_iter
+        self.direct_max_nodes = direct_max_nodes
+        # Krylov iterations used by the most recent solve, 0 for direct solves
+        self.iterations = 0
+
+    def choose_method(self, num_unknowns, symmetric, matrix_free=False):
+        if self.method != 'auto':
+            return self.method
+        if num_unknowns <= self.direct_max_nodes and not matrix_free:
+            return 'direct'
+        elif symmetric:
+            return 'cg'
+        else:
+            return 'gmres'
+
+    def solve(self, A, b, symmetric=False, x0=None):
+        matrix_free = isinstance(A, linalg.LinearOperator)
+        method = self.choose_method(A.shape[0], symmetric, matrix_free)
+        self.iterations = 0
+        if matrix_free and method in DIRECT_METHODS:
+            raise RuntimeError("Matrix-free operators need an iterative method, not " + method)
+        if method == 'dense':
+            return dense_linalg.solve(A.toarray(), b)
+        elif method == 'direct':
+            return linalg.spsolve(sps.csc_matrix(A), b)
+        elif method == 'splu':
+            return linalg.splu(sps.csc_matrix(A)).solve(b)
+        return self.solve_iterative(method, A, b, x0)
+
+    def solve_iterative(self, method, A, b, x0=None):
+        def count(*args):
+            self.iterations += 1
+        solver = ITERATIVE_METHODS[method]
+        x, info = solver(A, b, x0=x0, maxiter=self.max_iter, M=self.make_preconditioner(A),
+                         callback=count, **krylov_kwargs(solver, self.tol))
+        if info < 0:
+            raise RuntimeError("Breakdown in " + method + " linear solver")
+        if info > 0:
+            print("Warning: " + method + " did not converge in", info, "iterations")
+        return x
+
+    def make_preconditioner(self, A):
+        # Assembled and matrix-free operators both provide their diagonal
+        if self.preconditioner == 'jacobi':
+            inv_diag = 1/A.diagonal()
+            return linalg.LinearOperator(A.shape, matvec=lambda x: inv_diag*np.ravel(x),
+                                         dtype=np.float64)
+        return None
+
+
+def make_linear_solver(linear_solver):
+    # Accepts a LinearSolver, a method name or None for the default
+    if linear_solver is None:
+        return LinearSolver()
+    elif isinstance(linear_solver, LinearSolver):
+        return linear_solver
+    return LinearSolver(linear_solver)
+
+
+def sparse_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+class FactorizationCache():
+    def __init__(self, max_bytes=CACHE_BYTES):
+        """Least recently used cache of sparse LU factorizations, keyed by
+        e.g. (formulation, group, angle), that also holds assembled operators
+        and the warm starts of the iterative methods. Entries are evicted
+        oldest first once their total size would exceed max_bytes """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, build):
+        # Returns the entry stored under key, build is only called on a miss
+        # and returns the new entry and its size in bytes
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        entry, size = build()
+        self.store(key, entry, size)
+        return entry
+
+    def get(self, key):
+        # Returns the entry stored under key, or None, without counting a hit
+        # or a miss
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def store(self, key, entry, size):
+        # Stores entry under key, replacing an older entry. Entries too large
+        # to keep are not stored
+        self.discard_entry(key)
+        if size > self.max_bytes:
+            return
+        while self.nbytes + size > self.max_bytes:
+            self.evict()
+        self.entries[key] = (entry, size)
+        self.nbytes += size
+
+    def factorization(self, key, make_lhs):
+        # Returns the factorization stored under key, make_lhs is only called
+        # to assemble the operator on a miss
+        def build():
+            lu = linalg.splu(sps.csc_matrix(make_lhs()))
+            return lu, sparse_nbytes(lu.L) + sparse_nbytes(lu.U) + lu.perm_r.nbytes + lu.perm_c.nbytes
+        return self.lookup(key, build)
+
+    def operator(self, key, make_lhs):
+        # Returns the assembled operator stored under key, for the iterative
+        # methods that do not factor it
+        def build():
+            lhs = sps.csr_matrix(make_lhs())
+            return lhs, sparse_nbytes(lhs)
+        return self.lookup(('operator', key), build)
+
+    def solve(self, key, make_lhs, rhs):
+        return self.factorization(key, make_lhs).solve(rhs)
+
+    def discard(self, key):
+        # Drops the factorization and the assembled operator stored under key,
+        # for operators that have changed
+        for entry_key in [key, ('operator', key)]:
+            self.discard_entry(entry_key)
+
+    def discard_entry(self, key):
+        if key in self.entries:
+            _, size = self.entries.pop(key)
+            self.nbytes -= size
+
+    def evict(self):
+        _, (_, size) = self.entries.popitem(last=False)
+        self.nbytes -= size
+        self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.nbytes}
@@ -1,6 +1,9 @@
 import os
 import numpy as np
 
+# Per-material cross section arrays held by Materials
+MATERIAL_ARRAYS = ['sig_t', 'sig_a', 'sig_s', 'sig_f', 'D', 'nu', 'inv_sigt',
+                   'chi', 'sig_tr', 'sig_r']
 
 class Materials():
     def __init__(self, filename):
@@ -26,6 +29,7 @@ class Materials():
             self.inv_sigt = np.zeros((self.num_mats, self.num_groups))
             self.chi = np.zeros((self.num_mats, self.num_groups))
             self.sig_tr = np.zeros((self.num_mats, self.num_groups))
+            self.sig_r = np.zeros((self.num_mats, self.num_groups))
             for i in range(self.num_mats):
                 line = fp.readline()
                 attributes = line.split("|")
@@ -43,12 +47,27 @@ class Materials():
                     # Derived quantities
                     self.D[i, j] = 1 / (3 * self.sig_tr[i, j])
                     self.inv_sigt[i, j] = 1 / self.sig_t[i, j]
+                    self.sig_r[i, j] = self.sig_t[i, j] - self.sig_s[i, j, j]
                     if j == (self.num_groups - 1):
                         continue
                     else:
                         line = fp.readline()
                         attributes = line.split("|")
 
+    @classmethod
+    def from_arrays(cls, arrays, names=None):
+        """Builds materials from a dict holding every array in
+        MATERIAL_ARRAYS, e.g. views of shared memory in a worker process """
+        mats = cls.__new__(cls)
+        mats.num_mats, mats.num_groups = np.shape(arrays['sig_t'])
+        mats.names = names if names is not None else [str(i) for i in range(mats.num_mats)]
+        for name in MATERIAL_ARRAYS:
+            setattr(mats, name, arrays[name])
+        return mats
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in MATERIAL_ARRAYS}
+
     def get_name(self, mat_id):
         return self.names[mat_id]
 
@@ -86,7 +105,4 @@ class Materials():
         return self.inv_sigt[mat_id, group_id]
 
     def get_sigr(self, mat_id, group_id):
-        scatmat = self.get_sigs(mat_id)
-        sigt = self.get_sigt(mat_id, group_id)
-        sigr = sigt - scatmat[group_id, group_id]
-        return sigr
+        return self.sig_r[mat_id, group_id]
@@ -0,0 +1,149 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from gallo.fe import FEGrid
+from gallo.materials import Materials
+from gallo.formulations.saaf import SAAF
+from gallo.formulations.nda import AngularMoments
+
+MESH_ARRAYS = ['coords', 'connectivity', 'mat_ids', 'is_boundary']
+
+
+class SharedArrays():
+    def __init__(self, arrays):
+        """Copies a dict of numpy arrays into shared memory blocks, one per
+        array. specs describes the blocks so another process can attach """
+        self.blocks = {}
+        self.arrays = {}
+        self.specs = {}
+        for name, value in arrays.items():
+            value = np.ascontiguousarray(value)
+            block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            array = np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)
+            array[...] = value
+            self.blocks[name] = block
+            self.arrays[name] = array
+            self.specs[name] = (block.name, value.shape, value.dtype.str)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+def attach(specs):
+    # Maps the shared memory blocks described by specs into this process,
+    # the blocks must stay referenced for as long as the arrays are used
+    blocks, arrays = {}, {}
+    for name, (block_name, shape, dtype) in specs.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf)
+    return blocks, arrays
+
+
+# State of a worker process, set up once by init_worker
+_worker = {}
+
+
+def init_worker(specs, sn_ord, num_gauss_nodes, linear_solver, cache_bytes, matrix_free):
+    from gallo.solvers import Solver
+    blocks, arrays = attach(specs)
+    grid = FEGrid.from_arrays(*[arrays[name] for name in MESH_ARRAYS],
+                              sn_ord=sn_ord, num_gauss_nodes=num_gauss_nodes)
+    mats = Materials.from_arrays(arrays)
+    solver = Solver(SAAF(grid, mats), linear_solver=linear_solver, cache_bytes=cache_bytes,
+                    matrix_free=matrix_free)
+    _worker.update(blocks=blocks, arrays=arrays, solver=solver)
+
+
+def worker_cache_stats():
+    factorizations = _worker['solver'].factorizations
+    return factorizations.stats() if factorizations is not None else None
+
+
+def solve_angles(task):
+    # Solves the angles in angle_ids, reading the source and previous flux
+    # from and writing the angular fluxes to shared memory
+    group_id, angle_ids = task
+    arrays, solver = _worker['arrays'], _worker['solver']
+    solver.get_ang_fluxes(group_id, arrays['source'], arrays['phi_prev'], angle_ids,
+                          arrays['psi'])
+    return angle_ids, worker_cache_stats()
+
+
+def solve_moments(task):
+    # Solves the angles in angle_ids and returns their share of the angular
+    # moments of the NDA closure, the angular fluxes are not kept
+    group_id, angle_ids = task
+    arrays, solver = _worker['arrays'], _worker['solver']
+    moments = solver.get_ang_moments(group_id, arrays['source'], arrays['phi_prev'], angle_ids)
+    return moments.phi, moments.tensor, moments.boundary, worker_cache_stats()
+
+
+class AnglePool():
+    def __init__(self, grid, mat_data, n_workers, linear_solver=None, cache_bytes=None,
+                 matrix_free=False):
+        """Process pool that solves the SAAF angles of a group in parallel.
+        The mesh, the material data, the source, the previous scalar flux
+        and the angular fluxes live in shared memory, so tasks only carry
+        a group and a list of angles. Every worker has its own factorization
+        cache of cache_bytes """
+        self.n_workers = n_workers
+        self.fegrid = grid
+        self.num_angs = grid.num_angs
+        self.opposite_angs = grid.opposite_angs
+        arrays = {'coords': grid.coords, 'connectivity': grid.connectivity,
+                  'mat_ids': grid.mat_ids, 'is_boundary': grid.is_boundary}
+        arrays.update(mat_data.arrays())
+        num_groups = mat_data.get_num_groups()
+        arrays['source'] = np.zeros((num_groups, grid.num_elts))
+        arrays['phi_prev'] = np.zeros((num_groups, grid.num_nodes))
+        arrays['psi'] = np.zeros((grid.num_angs, grid.num_nodes))
+        self.shared = SharedArrays(arrays)
+        # Factorization cache statistics of the workers that solved the
+        # latest tasks, one entry per task
+        self.worker_stats = []
+        self.pool = mp.Pool(n_workers, initializer=init_worker,
+                            initargs=(self.shared.specs, grid.sn_ord, grid.num_gauss_nodes,
+                                      linear_solver, cache_bytes, matrix_free))
+
+    def chunks(self):
+        # Blocks of angles, one per worker, opposite directions are kept in
+        # the same block so they share their volume operator
+        first = [i for i in range(self.num_angs) if not 0 <= self.opposite_angs[i] < i]
+        chunks = [[j for i in chunk for j in (i, self.opposite_angs[i]) if j >= 0]
+                  for chunk in np.array_split(first, self.n_workers)]
+        return [chunk for chunk in chunks if len(chunk)]
+
+    def angular_fluxes(self, group_id, source, phi_prev):
+        self.shared['source'][...] = source
+        self.shared['phi_prev'][...] = phi_prev
+        results = self.pool.map(solve_angles, [(group_id, chunk) for chunk in self.chunks()])
+        self.worker_stats = [stats for _, stats in results]
+        return np.copy(self.shared['psi'])
+
+    def angular_moments(self, group_id, source, phi_prev):
+        # Sum of the angular moments of every block, in block order
+        self.shared['source'][...] = source
+        self.shared['phi_prev'][...] = phi_prev
+        moments = AngularMoments(self.fegrid)
+        self.worker_stats = []
+        for phi, tensor, boundary, stats in self.pool.map(solve_moments,
+                                                          [(group_id, chunk) for chunk in self.chunks()]):
+            moments.phi += phi
+            moments.tensor += tensor
+            moments.boundary += boundary
+            self.worker_stats.append(stats)
+        return moments
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
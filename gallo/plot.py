@@ -4,19 +4,7 @@ import numpy as np
 
 
 def _setup_triangles(grid):
-    # Get number of nodes
-    nodes = grid.num_nodes
-    # Setup xy
-    x = np.zeros(nodes)
-    y = np.zeros(nodes)
-    positions = (grid.node(i).position for i in range(nodes))
-    for i, pos in enumerate(positions):
-        x[i], y[i] = pos
-    # Setup triangles
-    elts = grid.num_elts
-    triangles = np.array([grid.element(i).vertices for i in range(elts)])
-    triang = tri.Triangulation(x, y, triangles=triangles)
-    return triang
+    return grid.setup_triangulation()
 
 def plot(grid, solution, filename=None, savefig=True):
     triang = _setup_triangles(grid)
@@ -42,11 +30,7 @@ def plot(grid, solution, filename=None, savefig=True):
 
 def plot_mesh(grid, filename):
     triang = _setup_triangles(grid)
-    elts = grid.num_elts
-    mats = np.zeros(elts)
-    for i in range(elts):
-        el = grid.element(i)
-        mats[i] = el.mat_id
+    mats = grid.mat_ids
     plt.figure()
     plt.triplot(triang)
     plt.tripcolor(triang, mats, shading='flat')
@@ -4,21 +4,106 @@ import time
 import numpy as np
 import scipy.sparse as sps
 import scipy.sparse.linalg as linalg
-import scipy.linalg as dense_linalg
 import matplotlib.tri as tri
 
 from gallo.formulations.diffusion import Diffusion
-from gallo.formulations.nda import NDA
+from gallo.formulations.nda import NDA, AngularMoments
 from gallo.formulations.saaf import SAAF
 from gallo.upscatter_acceleration import UA
+from gallo.anderson import Anderson
 from gallo.helpers import Helper
+from gallo.linear_solvers import (make_linear_solver, krylov_kwargs, FactorizationCache, CACHE_BYTES,
+                                  DIRECT_METHODS)
+
+# Number of SAAF angles whose right hand sides are built in one batched pass
+ANGLE_BLOCK = 16
+
+WITHIN_GROUP = ['source_iteration', 'gmres']
+# Krylov vectors kept by the within-group GMRES between restarts
+GMRES_RESTART = 20
+EIGENVALUE_ACCEL = [None, 'wielandt', 'chebyshev']
+
+# Consecutive within-group iterations with a growing change after which an
+# iteration with a flux dependent source is taken to diverge
+DIVERGENCE_ITERATIONS = 10
+
+# Plain power iteration steps before the Wielandt shift is applied, so the
+# shift follows an estimate of k instead of the initial guess
+WIELANDT_PLAIN_STEPS = 2
+
+# Tolerances of the outer and within-group iterations of every power
+# iteration step, and the loosest ones used by adaptive_tolerances
+OUTER_TOL = 1e-6
+INNER_TOL = 1e-8
+MAX_OUTER_TOL = 1e-2
+
+
+def adaptive_tolerances(residual, factor=0.1):
+    # Outer and within-group tolerances proportional to the eigenvalue
+    # residual of the last power iteration step, between the fixed
+    # tolerances and MAX_OUTER_TOL
+    outer_tol = min(max(factor*residual, OUTER_TOL), MAX_OUTER_TOL)
+    return outer_tol, outer_tol*INNER_TOL/OUTER_TOL
+
+
+def valid_shifted_step(k, fiss_source, inv_ks, shift):
+    # A Wielandt step with k_s = 1/inv_ks not above the eigenvalue gives a
+    # diverged or non-positive solution, or an eigenvalue estimate that
+    # approaches k_s, so the estimate has to stay below k_s by half the shift
+    return np.isfinite(k) and 0 < k*inv_ks*(1 + shift/2) < 1 and np.all(np.isfinite(fiss_source)) \
+        and not np.any(fiss_source < 0)
+
+
+def chebyshev_coefficients(step, dominance_ratio):
+    # Extrapolation coefficients of step p of a Chebyshev cycle for an
+    # iteration whose error modes decay by at most dominance_ratio,
+    # s_p+1 = s_p + alpha*(T s_p - s_p) + beta*(s_p - s_p-1)
+    if step == 1:
+        return 2/(2 - dominance_ratio), 0
+    gamma = np.arccosh(2/dominance_ratio - 1)
+    alpha = 4/dominance_ratio*np.cosh((step - 1)*gamma)/np.cosh(step*gamma)
+    return alpha, (1 - dominance_ratio/2)*alpha - 1
 
 class Solver():
-    def __init__(self, operator):
+    def __init__(self, operator, linear_solver=None, cache_bytes=CACHE_BYTES, n_workers=None,
+                 warm_start=True, matrix_free=False):
         self.op = operator
+        # SAAF and Diffusion operators are applied from their element
+        # matrices instead of being assembled, for NDA this applies to the
+        # high order solves
+        self.matrix_free = matrix_free and not isinstance(self.op, NDA)
         self.ua_bool = False
+        # Number of group solves, see count_transport_solves
+        self.transport_solves = 0
+        # Acceleration of the outer iteration over groups, None or an Anderson
+        self.anderson = None
+        # Within-group iteration, one of WITHIN_GROUP
+        self.within_group = 'source_iteration'
+        # Diffusion synthetic acceleration of the SAAF source iteration
+        self.dsa = False
+        if isinstance(self.op, SAAF):
+            self.dsa_op = Diffusion(self.op.fegrid, self.op.mat_data)
+            self.dsa_scattering = {}
+        # Number of processes sharing the SAAF angle solves, serial if None or
+        # 1. Every worker keeps its own factorization cache of cache_bytes, so
+        # a pool can use n_workers times the budget
+        self.n_workers = n_workers
+        self.angle_pool = None
+        self.linear_solver = make_linear_solver(linear_solver)
+        # Factorizations of operators that are fixed for a (group, angle),
+        # disabled when cache_bytes is 0 or None
+        self.factorizations = FactorizationCache(cache_bytes) if cache_bytes else None
+        # Start the iterative linear solvers from the previous solution of
+        # the system, kept in the factorization cache within its budget
+        self.warm_start = warm_start
         if isinstance(self.op, NDA):
+            # One high order solver for the whole run, sharing the
+            # factorizations, so repeated high order solves only update the
+            # right hand sides
             self.ho_op = SAAF(self.op.fegrid, self.op.mat_data)
+            self.ho_solver = Solver(self.ho_op, linear_solver=self.linear_solver, cache_bytes=None,
+                                    warm_start=warm_start, matrix_free=matrix_free)
+            self.ho_solver.factorizations = self.factorizations
         self.mat_data = self.op.mat_data
         self.num_groups = self.op.num_groups
         self.num_nodes = self.op.num_nodes
@@ -29,28 +114,153 @@ class Solver():
         self.weights = self.op.fegrid.weights
         self.helper = Helper(self.op.fegrid, self.mat_data)
 
-    def get_ang_flux(self, group_id, source, ang, angle_id, phi_prev):
-        lhs = self.op.make_lhs(ang, group_id).todense()
-        rhs = self.op.make_rhs(group_id, source, ang, angle_id, phi_prev)
-        ang_flux = dense_linalg.solve(lhs, rhs)[0]
+    def get_ang_flux(self, group_id, source, ang, angle_id, phi_prev, rhs=None):
+        if rhs is None:
+            rhs = self.op.make_rhs(group_id, source, ang, angle_id, phi_prev)
+        key = (type(self.op).__name__, group_id, angle_id)
+        make_lhs = self.op.lhs_operator if self.matrix_free else self.op.make_lhs
+        ang_flux = self.linear_solve(key, lambda: make_lhs(ang, group_id), rhs)
         return ang_flux
 
-    def get_scalar_flux(self, group_id, source, phi_prev, ho_sols=None):
+    def get_ang_fluxes(self, group_id, source, phi_prev, angle_ids, ang_fluxes):
+        # Solves the angles in angle_ids into the rows of ang_fluxes
+        for i, ang_flux in self.iter_ang_fluxes(group_id, source, phi_prev, angle_ids):
+            ang_fluxes[i] = ang_flux
+        return ang_fluxes
+
+    def iter_ang_fluxes(self, group_id, source, phi_prev, angle_ids):
+        # Solves the angles in angle_ids and yields (angle_id, ang_flux) one
+        # angle at a time. An angle and its opposite direction are solved
+        # together when both are in angle_ids, so they share the volume
+        # operator. Right hand sides are built in batched passes over blocks
+        # of ANGLE_BLOCK angles, so only one block is held at a time
+        angle_ids = list(angle_ids)
+        opposite = self.op.fegrid.opposite_angs
+        pairs = []
+        for i in angle_ids:
+            j = opposite[i] if opposite[i] in angle_ids else -1
+            if 0 <= j < i:
+                continue
+            pairs.append((i, j))
+        pairs_per_block = max(ANGLE_BLOCK // 2, 1)
+        for start in range(0, len(pairs), pairs_per_block):
+            block = pairs[start:start + pairs_per_block]
+            block_ids = [k for pair in block for k in pair if k >= 0]
+            rhs = dict(zip(block_ids, self.op.make_rhs_all(group_id, source, phi_prev,
+                                                           self.angs[block_ids])))
+            for i, j in block:
+                ang = np.array(self.angs[i])
+                if j >= 0:
+                    ang_flux, opposite_flux = self.get_ang_flux_pair(group_id, ang, i, j, rhs[i], rhs[j])
+                    yield i, ang_flux
+                    yield j, opposite_flux
+                else:
+                    yield i, self.get_ang_flux(group_id, source, ang, i, phi_prev, rhs=rhs[i])
+
+    def get_ang_moments(self, group_id, source, phi_prev, angle_ids):
+        # Angular moments of the angles in angle_ids for the NDA closure,
+        # accumulated as each angle is solved
+        moments = AngularMoments(self.op.fegrid)
+        for i, ang_flux in self.iter_ang_fluxes(group_id, source, phi_prev, angle_ids):
+            moments.add(self.angs[i], self.weights[i], ang_flux)
+        return moments
+
+    def get_ang_flux_pair(self, group_id, ang, angle_id, opposite_id, rhs, rhs_opposite):
+        # Both operators are assembled together, and only if one of them is
+        # not in the factorization cache
+        if self.matrix_free:
+            return (self.get_ang_flux(group_id, None, ang, angle_id, None, rhs=rhs),
+                    self.get_ang_flux(group_id, None, np.array(self.angs[opposite_id]), opposite_id,
+                                      None, rhs=rhs_opposite))
+        lhs_pair = []
+        def make_lhs(k):
+            if not lhs_pair:
+                lhs_pair.extend(self.op.make_lhs_pair(ang, group_id))
+            return lhs_pair[k]
+        name = type(self.op).__name__
+        ang_flux = self.linear_solve((name, group_id, angle_id), lambda: make_lhs(0), rhs)
+        opposite_flux = self.linear_solve((name, group_id, opposite_id), lambda: make_lhs(1), rhs_opposite)
+        return ang_flux, opposite_flux
+
+    def linear_solve(self, key, make_lhs, rhs, fixed=True):
+        # Operators that do not change between iterations (fixed) are factored
+        # once and reused from the cache when a direct method is in use, or
+        # kept assembled for the iterative methods. Iterative methods start
+        # from the previous solution, stored in the cache under
+        # ('warm start', key). Matrix-free operators are cheap to form and
+        # are not cached
+        method = self.linear_solver.choose_method(self.num_nodes, self.op.symmetric, self.matrix_free)
+        if self.matrix_free and method in DIRECT_METHODS:
+            raise RuntimeError("Matrix-free operators need an iterative method, not " + method)
+        if method in DIRECT_METHODS:
+            if fixed and self.factorizations is not None and method != 'dense':
+                return self.factorizations.solve(key, make_lhs, rhs)
+            return self.linear_solver.solve(make_lhs(), rhs, symmetric=self.op.symmetric)
+        if fixed and self.factorizations is not None and not self.matrix_free:
+            lhs = self.factorizations.operator(key, make_lhs)
+        else:
+            lhs = make_lhs()
+        warm_start = self.warm_start and self.factorizations is not None
+        x0 = self.factorizations.get(('warm start', key)) if warm_start else None
+        solution = self.linear_solver.solve(lhs, rhs, symmetric=self.op.symmetric, x0=x0)
+        if warm_start:
+            self.factorizations.store(('warm start', key), solution, solution.nbytes)
+        return solution
+
+    def get_scalar_flux(self, group_id, source, phi_prev, ho_sols=None, moments=False):
+        # With moments the SAAF angular fluxes are reduced to the angular
+        # moments of the NDA closure instead of being returned
         scalar_flux = 0
+        if not isinstance(self.op, NDA):
+            self.transport_solves += 1
         if isinstance(self.op, Diffusion) or isinstance(self.op, NDA):
-            lhs = self.op.make_lhs(group_id, ho_sols=ho_sols).todense()
             rhs = self.op.make_rhs(group_id, source, phi_prev)
-            scalar_flux = dense_linalg.solve(lhs, rhs)
+            # The NDA operator depends on the latest high order solution
+            key = (type(self.op).__name__, group_id, None)
+            make_lhs = self.op.lhs_operator if self.matrix_free else self.op.make_lhs
+            scalar_flux = self.linear_solve(key, lambda: make_lhs(group_id, ho_sols=ho_sols), rhs,
+                                            fixed=isinstance(self.op, Diffusion))
             return {"Phi": scalar_flux, "Psi": None}
+        elif moments:
+            if self.angle_pool is not None:
+                ang_moments = self.angle_pool.angular_moments(group_id, source, phi_prev)
+            else:
+                ang_moments = self.get_ang_moments(group_id, source, phi_prev, range(self.num_angs))
+            return {"Phi": ang_moments.phi, "Psi": None, "Moments": ang_moments}
         else:
-            ang_fluxes = np.zeros((self.num_angs, self.num_nodes))
-            # Iterate over all angle possibilities
-            for i, ang in enumerate(self.angs):
-                ang = np.array(ang)
-                ang_fluxes[i] = self.get_ang_flux(group_id, source, ang, i, phi_prev)
+            if self.angle_pool is not None:
+                ang_fluxes = self.angle_pool.angular_fluxes(group_id, source, phi_prev)
+            else:
+                ang_fluxes = np.zeros((self.num_angs, self.num_nodes))
+                self.get_ang_fluxes(group_id, source, phi_prev, range(self.num_angs), ang_fluxes)
+            # Sum in angle order so serial and parallel runs agree exactly
+            for i in range(self.num_angs):
                 scalar_flux += self.weights[i] * ang_fluxes[i]
             return {"Phi": scalar_flux, "Psi": ang_fluxes}
 
+    def start_pool(self):
+        # The pool solves SAAF angles, also for the high order solves of NDA
+        if self.n_workers is not None and self.n_workers > 1 and self.angle_pool is None:
+            if isinstance(self.op, SAAF) or isinstance(self.op, NDA):
+                cache_bytes = self.factorizations.max_bytes if self.factorizations is not None else None
+                saaf_solver = self.ho_solver if isinstance(self.op, NDA) else self
+                try:
+                    # Shared memory needs Python 3.8, serial runs do not
+                    from gallo.parallel import AnglePool
+                except ImportError:
+                    raise RuntimeError("Parallel angle solves need Python 3.8 or later")
+                self.angle_pool = AnglePool(self.op.fegrid, self.mat_data, self.n_workers,
+                                            self.linear_solver, cache_bytes, saaf_solver.matrix_free)
+                if isinstance(self.op, NDA):
+                    self.ho_solver.angle_pool = self.angle_pool
+
+    def stop_pool(self):
+        if self.angle_pool is not None:
+            self.angle_pool.close()
+            self.angle_pool = None
+            if isinstance(self.op, NDA):
+                self.ho_solver.angle_pool = None
+
     def solve_in_group(self, source, group_id, phi_prev, max_iter=1000,
                        tol=1e-8, verbose=True):
         num_mats = self.mat_data.get_num_mats()
@@ -60,45 +270,128 @@ class Solver():
                 scattering = False
             else:
                 scattering = True
+        # A source that depends on the fluxes (the shifted fission source of
+        # a Wielandt iteration) is updated every within-group iteration like
+        # the scattering source
+        source_fn = source if callable(source) else None
+        scattering = scattering or source_fn is not None
         if self.num_groups > 1 and verbose:
             print("Starting Group ", group_id)
+        if self.within_group == 'gmres' and scattering:
+            return self.solve_in_group_gmres(source, group_id, phi_prev, max_iter, tol, verbose)
         if isinstance(self.op, NDA):
             # Run preliminary solve on low-order system
+            if source_fn is not None:
+                source = source_fn(phi_prev)
             ho_sols = 0
             fluxes = self.get_scalar_flux(group_id, source, phi_prev, ho_sols=ho_sols)
             phi_prev[group_id] = fluxes['Phi']
+        # Consecutive iterations whose change grew, a flux dependent source
+        # can make the iteration supercritical
+        prev_norm = float('inf')
+        increases = 0
+        diverged = False
         for i in range(1, max_iter):
             if scattering and verbose:
                 print("Within-Group Iteration: ", i)
+            if source_fn is not None:
+                source = source_fn(phi_prev)
             if isinstance(self.op, NDA):
-                ho_solver = Solver(self.ho_op)
-                fluxes_ho = ho_solver.get_scalar_flux(group_id, source, phi_prev)
-                ho_phis, ho_psis = fluxes_ho['Phi'], fluxes_ho['Psi']
-                fluxes = self.get_scalar_flux(group_id, source, phi_prev, ho_sols=[ho_phis, ho_psis])
+                # Only the angular moments of the closure are kept from the
+                # high order solve, not the angular fluxes
+                ho_moments = self.ho_solver.get_scalar_flux(group_id, source, phi_prev, moments=True)['Moments']
+                fluxes = self.get_scalar_flux(group_id, source, phi_prev, ho_sols=ho_moments)
             else:
                 fluxes = self.get_scalar_flux(group_id, source, phi_prev)
             phi = fluxes['Phi']
             if not scattering:
                 break
+            if self.dsa:
+                phi = phi + self.dsa_correction(group_id, phi, phi_prev[group_id])
             norm = np.linalg.norm(phi - phi_prev[group_id], float('inf'))/np.linalg.norm(phi, float('inf'))
             if verbose: print("Norm: ", norm)
             if norm < tol:
                 break
+            increases = increases + 1 if norm >= prev_norm else 0
+            prev_norm = norm
+            if not np.isfinite(norm) or (source_fn is not None and increases >= DIVERGENCE_ITERATIONS):
+                print("Warning: within-group iteration diverged")
+                diverged = True
+                break
             phi_prev[group_id] = np.copy(phi)
         if i == max_iter:
             print("Warning: maximum number of iterations reached in solver")
         if self.num_groups > 1 and verbose:
             print("Finished Group ", group_id)
         if scattering and verbose:
-            print("Number of Within-Group Iterations: ", i + 1)
+            print("Number of Within-Group Iterations: ", i)
             print("Final Phi Norm: ", norm)
         if isinstance(self.op, NDA):
-            return {"Phi": phi, "Psi": None, "HO": [ho_phis, ho_psis]}
+            return {"Phi": phi, "Psi": None, "HO": ho_moments, "Iterations": i, "Diverged": diverged}
         else:
-            return {"Phi": phi, "Psi": fluxes['Psi'], "HO": None}
+            return {"Phi": phi, "Psi": fluxes['Psi'], "HO": None, "Iterations": i, "Diverged": diverged}
 
-    def solve_outer(self, source, phis, verbose=True, max_iter=50, tol=1e-6):
-        ang_fluxes = np.zeros((self.num_groups, self.num_angs, self.num_nodes))
+    def solve_in_group_gmres(self, source, group_id, phi_prev, max_iter, tol, verbose):
+        # The within-group problem as the linear system (I - A) phi = b, where
+        # phi -> A phi + b is one transport solve over all angles with phi in
+        # the within-group scattering source, solved with GMRES
+        phis = np.copy(phi_prev)
+        transport_solves = [0]
+        def transport(phi):
+            transport_solves[0] += 1
+            phis[group_id] = phi
+            group_source = source(phis) if callable(source) else source
+            return self.get_scalar_flux(group_id, group_source, phis)
+        b = transport(np.zeros(self.num_nodes))['Phi']
+        def matvec(phi):
+            phi = np.ravel(phi)
+            return phi - (transport(phi)['Phi'] - b)
+        lhs = linalg.LinearOperator((self.num_nodes, self.num_nodes), matvec=matvec, dtype=np.float64)
+        residuals = []
+        # maxiter counts restart cycles, so max_iter bounds the GMRES
+        # iterations. Every cycle also evaluates its residual, and the right
+        # hand side and the final angular fluxes take one solve each, so up to
+        # max_iter + 2*cycles + 2 transport solves
+        restart = min(GMRES_RESTART, max_iter)
+        phi, info = linalg.gmres(lhs, b, x0=phi_prev[group_id], restart=restart,
+                                 maxiter=max(max_iter // restart, 1), callback=residuals.append,
+                                 **krylov_kwargs(linalg.gmres, tol))
+        if info > 0:
+            print("Warning: maximum number of iterations reached in solver")
+        # One more solve for the angular fluxes of the converged phi
+        fluxes = transport(phi)
+        if verbose:
+            print("Number of Within-Group Iterations: ", transport_solves[0])
+            print("Final Residual Norm: ", residuals[-1] if residuals else 0)
+        return {"Phi": fluxes['Phi'], "Psi": fluxes['Psi'], "HO": None,
+                "Iterations": transport_solves[0], "Residuals": residuals,
+                "Diverged": not np.all(np.isfinite(fluxes['Phi']))}
+
+    def dsa_correction(self, group_id, phi, phi_prev):
+        # Diffusion solve for the error left by the lagged within-group
+        # scattering source, -div(D grad(delta)) + sig_r*delta =
+        # sig_s[g, g]*(phi - phi_prev), with the Diffusion operator of the group
+        if group_id not in self.dsa_scattering:
+            self.dsa_scattering[group_id] = self.helper.scattering_matrices(group_id, self_scatter=True)[group_id]
+        rhs = self.dsa_scattering[group_id] @ (phi - phi_prev)
+        make_lhs = self.dsa_op.lhs_operator if self.matrix_free else self.dsa_op.make_lhs
+        return self.linear_solve(('DSA', group_id, None), lambda: make_lhs(group_id), rhs)
+
+    def solve_outer(self, source, phis, verbose=True, max_iter=50, tol=1e-6, inner_max_iter=1000,
+                    inner_tol=1e-8):
+        # source is an array or a function of the latest fluxes, evaluated
+        # before every group solve. inner_max_iter and inner_tol are passed
+        # to the within-group solves
+        source_fn = source if callable(source) else None
+        # NDA keeps no angular fluxes
+        ang_fluxes = None if isinstance(self.op, NDA) else np.zeros((self.num_groups, self.num_angs, self.num_nodes))
+        # Within-group iterations of every group, summed over outer iterations,
+        # and the GMRES residual history of every within-group solve
+        iterations = np.zeros(self.num_groups, dtype=int)
+        residuals = [[] for g in range(self.num_groups)]
+        if self.anderson is not None:
+            self.anderson.reset()
+        diverged = False
         for it_count in range(1, max_iter):
             if self.num_groups != 1 and verbose:
                 print("Gauss-Seidel Iteration: ", it_count)
@@ -107,16 +400,24 @@ class Solver():
                 all_ho_sols = []
             for g in range(self.num_groups):
                 if isinstance(self.op, NDA):
-                    fluxes = self.solve_in_group(source, g, phis, verbose=verbose)
+                    fluxes = self.solve_in_group(source, g, phis, max_iter=inner_max_iter,
+                                                 tol=inner_tol, verbose=verbose)
                     all_ho_sols.append(fluxes['HO'])
                 else:
-                    fluxes = self.solve_in_group(source, g, phis)
+                    fluxes = self.solve_in_group(source, g, phis, max_iter=inner_max_iter,
+                                                 tol=inner_tol, verbose=verbose)
                     ang_fluxes[g] = fluxes['Psi']
                 phis[g] = fluxes['Phi']
-            if self.num_groups == 1:
+                iterations[g] += fluxes['Iterations']
+                if 'Residuals' in fluxes:
+                    residuals[g].append(fluxes['Residuals'])
+                diverged = diverged or fluxes['Diverged']
+            if diverged:
+                break
+            if self.num_groups == 1 and source_fn is None:
                 break
             else:
-                if self.ua_bool:
+                if self.ua_bool and self.num_groups > 1:
                     # Calculate Correction Term
                     print("Calculating Upscatter Acceleration Term")
                     upscatter_accelerator = UA(self.op)
@@ -125,56 +426,327 @@ class Solver():
                     for midx in range(self.num_mats):
                         eig_for_mat[midx] = upscatter_accelerator.compute_eigenfunction(midx)
                     eigs = np.zeros((self.num_groups, self.num_nodes))
+                    fegrid = self.op.fegrid
                     for g in range(self.num_groups):
-                        for elt in range(self.num_elts):
-                            e = self.op.fegrid.element(elt)
-                            midx = e.mat_id
-                            for n in range(3):
-                                n_global = self.op.fegrid.node(elt, n)
-                                nid = n_global.id
-                                eigs[g, nid] += eig_for_mat[midx, g]*1/3
+                        elt_eigs = eig_for_mat[fegrid.mat_ids, g]*1/3
+                        for n in range(3):
+                            np.add.at(eigs[g], fegrid.connectivity[:, n], elt_eigs)
                     epsilon = upscatter_accelerator.calculate_correction(phis, phis_prev, all_ho_sols)
                     phis += epsilon*eigs
                 res = np.linalg.norm(phis - phis_prev, float('inf'))/np.linalg.norm(phis, float('inf'))
                 if verbose:
                     print("GS Norm: ", res)
+                if not np.isfinite(res):
+                    print("Warning: outer iteration diverged")
+                    diverged = True
+                    break
+                if self.anderson is not None and res >= tol:
+                    # Mix the result of this sweep with the previous ones
+                    phis[...] = self.anderson.update(phis_prev.ravel(), phis.ravel()).reshape(phis.shape)
             if res < tol:
                 break
-        return {"Phi": phis, "Psi": ang_fluxes}
+        if verbose:
+            print("Within-Group Iterations per Group: ", iterations)
+        return {"Phi": phis, "Psi": ang_fluxes, "Iterations": iterations, "Residuals": residuals,
+                "Outer Iterations": it_count, "Diverged": diverged}
 
-    def power_iteration(self, source, tol=1e-4):
+    def power_iteration(self, source, tol=1e-4, accel=None, shift=0.2, max_iter=500,
+                        cheb_length=6, sweeps=None, adaptive=False, reference=None, verbose=True):
+        # Power iteration on the fission source, normalized to integrate to
+        # one, the external source is not used. accel is one of
+        # EIGENVALUE_ACCEL:
+        #   'wielandt': the fission source of a shifted eigenvalue
+        #   k_s = (1 + shift)*k, following the latest k, is moved into the
+        #   fixed source solves, which shrinks the dominance ratio. The
+        #   shifted source is converged by the within-group iteration, so
+        #   this pays off with within_group='gmres'. The shift starts after
+        #   WIELANDT_PLAIN_STEPS plain steps, and a shifted step that fails
+        #   because k_s is not above the eigenvalue is redone as a plain step
+        #   with the shift doubled
+        #   'chebyshev': after two plain steps that estimate the dominance
+        #   ratio, cycles of cheb_length Chebyshev extrapolated steps
+        # Every fixed source solve is converged unless sweeps is set, which
+        # flattens the iteration to at most sweeps outer and within-group
+        # iterations per fission source update. With adaptive the outer and
+        # within-group tolerances follow the latest eigenvalue residual, see
+        # adaptive_tolerances. The savings of an acceleration are measured
+        # against a plain run of the same problem: with reference, the result
+        # of such a run, "Transport Solves Saved" is the difference of their
+        # transport solves, negative when the acceleration costs more
+        if accel not in EIGENVALUE_ACCEL:
+            raise RuntimeError("Eigenvalue acceleration " + str(accel) + " not supported")
+        solves_start = self.count_transport_solves()
         k = 1
         phi = np.ones((self.num_groups, self.num_nodes))
-        fiss_source = self.helper.make_full_fission_source(phi)
-        int_fiss = self.helper.integrate_flux(fiss_source)
+        fiss_source = self.normalized_fission_source(phi)
+        # Fission sources of the plain steps since the last extrapolation,
+        # for the dominance ratio estimate
+        plain_sources = [fiss_source]
+        dominance_ratio = None
+        cheb_step = 0
+        prev_source = None
         err = 1
-        it = 0
-        while err > tol:
-            it += 1
-            print("Power Iteration ", it)
-            fluxes = self.solve_outer(fiss_source, (1/k)*phi)
-            phi_new = fluxes['Phi']
-            fiss_source_new = self.helper.make_full_fission_source(phi_new)
-            int_fiss_new = self.helper.integrate_flux(fiss_source_new)  # Integrate Fission Source
-            k_new = k*(int_fiss_new/int_fiss)
-            err_k = np.linalg.norm((k_new - k)/k_new)
-            err_phi = np.linalg.norm((phi_new - phi)/phi_new)
-            err = max(err_k, err_phi)
-            print("PI Norm: ", err)
-            int_fiss = np.copy(int_fiss_new)
-            phi = np.copy(phi_new)
-            k = np.copy(k_new)
-        return {"Phi": phi, "Psi": fluxes['Psi'], "k": k}
-
-    def solve(self, source, ua_bool=False, eigenvalue=False):
+        for it in range(1, max_iter + 1):
+            if verbose:
+                print("Power Iteration ", it)
+            shifted = accel == 'wielandt' and it > WIELANDT_PLAIN_STEPS
+            inv_ks = 1/((1 + shift)*k) if shifted else 0
+            outer_tol, inner_tol = adaptive_tolerances(err) if adaptive else (OUTER_TOL, INNER_TOL)
+            fluxes, k_new, new_source = self.power_step(fiss_source, k, inv_ks, phi, sweeps,
+                                                        outer_tol, inner_tol)
+            if inv_ks and (fluxes['Diverged'] or not valid_shifted_step(k_new, new_source, inv_ks, shift)):
+                print("Warning: Wielandt shift below the eigenvalue, repeating the step unshifted")
+                shift *= 2
+                fluxes, k_new, new_source = self.power_step(fiss_source, k, 0, phi, sweeps,
+                                                            outer_tol, inner_tol)
+            phi = fluxes['Phi']
+            err_k = np.abs(k_new - k)/k_new
+            err_source = np.max(np.abs(new_source - fiss_source))/np.max(np.abs(new_source))
+            err = max(err_k, err_source)
+            if verbose:
+                print("PI Norm: ", err)
+            k = k_new
+            if err < tol:
+                fiss_source = new_source
+                break
+            if cheb_step == 0:
+                plain_sources.append(new_source)
+                if len(plain_sources) >= 3:
+                    s0, s1, s2 = plain_sources[-3:]
+                    dominance_ratio = np.linalg.norm(s2 - s1)/np.linalg.norm(s1 - s0)
+            if accel == 'chebyshev' and dominance_ratio is not None and 0 < dominance_ratio < 1 \
+                    and len(plain_sources) >= 3:
+                # Chebyshev extrapolation of the fission source
+                cheb_step += 1
+                alpha, beta = chebyshev_coefficients(cheb_step, dominance_ratio)
+                extrapolated = fiss_source + alpha*(new_source - fiss_source)
+                if cheb_step > 1:
+                    extrapolated += beta*(fiss_source - prev_source)
+                prev_source = fiss_source
+                if np.any(extrapolated < 0):
+                    # Fall back to the plain step and end the cycle
+                    extrapolated = new_source
+                    cheb_step = cheb_length
+                fiss_source = extrapolated / self.helper.integrate_flux(extrapolated)
+                if cheb_step == cheb_length:
+                    # The next cycle starts after two plain steps that
+                    # update the dominance ratio estimate
+                    cheb_step = 0
+                    plain_sources = [fiss_source]
+            else:
+                fiss_source = new_source
+        else:
+            print("Warning: maximum number of power iterations reached")
+        transport_solves = self.count_transport_solves() - solves_start
+        if verbose:
+            print("Transport Solves: ", transport_solves)
+            print("Dominance Ratio Estimate: ", dominance_ratio)
+        fluxes = {"Phi": phi, "Psi": fluxes['Psi'], "k": k, "Power Iterations": it,
+                  "Transport Solves": transport_solves, "Dominance Ratio": dominance_ratio}
+        if reference is not None:
+            fluxes["Transport Solves Saved"] = reference['Transport Solves'] - transport_solves
+            if verbose:
+                print("Transport Solves Saved: ", fluxes["Transport Solves Saved"])
+        return fluxes
+
+    def arnoldi(self, source, num_modes=1, tol=1e-6, verbose=True):
+        # Eigenvalues of the fission source operator s -> F (L - S)^-1 s, one
+        # fixed source multigroup solve per application, by implicitly
+        # restarted Arnoldi (ARPACK). Returns the fundamental mode and the
+        # num_modes largest eigenvalues with their fission sources, the
+        # external source is not used
+        solves_start = self.count_transport_solves()
+        shape = (self.num_groups, self.num_elts)
+        size = self.num_groups*self.num_elts
+        if not 0 < num_modes < size - 1:
+            raise RuntimeError("Number of modes must be between 1 and " + str(size - 2))
+        phi = np.ones((self.num_groups, self.num_nodes))
+        applications = [0]
+        def matvec(fiss_source):
+            applications[0] += 1
+            fluxes = self.solve_outer(np.reshape(fiss_source, shape), np.copy(phi), verbose=False)
+            return self.helper.make_full_fission_source(fluxes['Phi']).ravel()
+        fission_operator = linalg.LinearOperator((size, size), matvec=matvec, dtype=np.float64)
+        v0 = self.normalized_fission_source(phi).ravel()
+        values, vectors = linalg.eigs(fission_operator, k=num_modes, v0=v0, tol=tol, which='LM')
+        order = np.argsort(-np.abs(values))
+        values, vectors = values[order], vectors[:, order]
+        if np.abs(values[0].imag) > tol*np.abs(values[0]):
+            raise RuntimeError("Fundamental eigenvalue is complex")
+        k = values[0].real
+        # Fission sources of the modes, the fundamental one positive and
+        # integrating to one, the others scaled by their integrated magnitude
+        sources = np.real(vectors.T).reshape((num_modes,) + shape)
+        for mode in range(num_modes):
+            sign = np.sign(self.helper.integrate_flux(sources[mode])) if mode == 0 else 1
+            sources[mode] *= sign/self.helper.integrate_flux(np.abs(sources[mode]))
+        # One more solve for the fluxes of the fundamental mode
+        fluxes = self.solve_outer(sources[0]/k, np.copy(phi), verbose=False)
+        transport_solves = self.count_transport_solves() - solves_start
+        if verbose:
+            print("Arnoldi Operator Applications: ", applications[0])
+            print("Transport Solves: ", transport_solves)
+        return {"Phi": fluxes['Phi'], "Psi": fluxes['Psi'], "k": k, "Harmonics": values,
+                "Fission Sources": sources, "Operator Applications": applications[0],
+                "Transport Solves": transport_solves}
+
+    def nda_eigenvalue(self, source, tol=1e-4, max_iter=100, lo_tol=None, lo_max_iter=1000,
+                       verbose=True):
+        # NDA eigenvalue iteration, the external source is not used. Every
+        # high order iteration is one SAAF sweep per group with the latest
+        # low order fluxes in the scattering source and fission source, and
+        # only updates the closures. k and the fission source are then
+        # converged on the multigroup low order system with the closures
+        # fixed, see lo_eigenvalue
+        if not isinstance(self.op, NDA):
+            raise RuntimeError("The NDA eigenvalue iteration needs an NDA operator")
+        if lo_tol is None:
+            lo_tol = tol/10
+        solves_start = self.count_transport_solves()
+        k = 1
+        phi = np.ones((self.num_groups, self.num_nodes))
+        fiss_source = self.normalized_fission_source(phi)
+        lo_iterations = 0
+        for it in range(1, max_iter + 1):
+            if verbose:
+                print("NDA Eigenvalue Iteration ", it)
+            ho_moments = [self.ho_solver.get_scalar_flux(g, fiss_source/k, phi, moments=True)['Moments']
+                          for g in range(self.num_groups)]
+            phi, k_new, new_source, lo_its = self.lo_eigenvalue(ho_moments, phi, k, fiss_source,
+                                                                lo_tol, lo_max_iter)
+            lo_iterations += lo_its
+            err_k = np.abs(k_new - k)/k_new
+            err_source = np.max(np.abs(new_source - fiss_source))/np.max(np.abs(new_source))
+            err = max(err_k, err_source)
+            if verbose:
+                print("k: ", k_new, " NDA Norm: ", err)
+            k, fiss_source = k_new, new_source
+            if err < tol:
+                break
+        else:
+            print("Warning: maximum number of NDA eigenvalue iterations reached")
+        transport_solves = self.count_transport_solves() - solves_start
+        if verbose:
+            print("Low Order Iterations: ", lo_iterations)
+            print("Transport Solves: ", transport_solves)
+        return {"Phi": phi, "Psi": None, "k": k, "Power Iterations": it,
+                "LO Iterations": lo_iterations, "Transport Solves": transport_solves}
+
+    def lo_eigenvalue(self, ho_moments, phi, k, fiss_source, tol, max_iter):
+        # Power iteration on the low order system with the closures of
+        # ho_moments, one Gauss-Seidel sweep over the groups per fission
+        # source update. The operators are fixed for the whole solve, so they
+        # replace the ones of the previous closures in the cache
+        phi = np.copy(phi)
+        lhs = {}
+        def make_lhs(g):
+            if g not in lhs:
+                lhs[g] = self.op.make_lhs(g, ho_sols=ho_moments[g])
+            return lhs[g]
+        if self.factorizations is not None:
+            for g in range(self.num_groups):
+                self.factorizations.discard(('NDA', g, None))
+        for it in range(1, max_iter + 1):
+            for g in range(self.num_groups):
+                rhs = self.op.make_rhs(g, fiss_source/k, phi)
+                phi[g] = self.linear_solve(('NDA', g, None), lambda: make_lhs(g), rhs)
+            new_source = self.helper.make_full_fission_source(phi)
+            int_fiss = self.helper.integrate_flux(new_source)
+            k_new = k*int_fiss
+            new_source = new_source / int_fiss
+            err = max(np.abs(k_new - k)/k_new,
+                      np.max(np.abs(new_source - fiss_source))/np.max(np.abs(new_source)))
+            k, fiss_source = k_new, new_source
+            if err < tol:
+                break
+        else:
+            print("Warning: maximum number of low order iterations reached")
+        return phi, k, fiss_source, it
+
+    def normalized_fission_source(self, phi):
+        fiss_source = self.helper.make_full_fission_source(phi)
+        return fiss_source / self.helper.integrate_flux(fiss_source)
+
+    def power_step(self, fiss_source, k, inv_ks, phi, sweeps=None, outer_tol=OUTER_TOL,
+                   inner_tol=INNER_TOL):
+        # Solves (L - S - F/k_s) phi = (1/k - 1/k_s) fiss_source, with the
+        # shifted fission term lagged by one outer sweep, and returns the new
+        # fluxes, eigenvalue and normalized fission source. inv_ks = 0 is a
+        # plain power iteration step. With sweeps the solve is stopped after
+        # that many outer and within-group iterations
+        weight = 1/k - inv_ks
+        if inv_ks:
+            source = lambda phis: weight*fiss_source + inv_ks*self.helper.make_full_fission_source(phis)
+        else:
+            source = weight*fiss_source
+        if sweeps is None:
+            fluxes = self.solve_outer(source, np.copy(phi), verbose=False, tol=outer_tol,
+                                      inner_tol=inner_tol)
+        else:
+            fluxes = self.solve_outer(source, np.copy(phi), verbose=False, max_iter=sweeps + 1,
+                                      tol=outer_tol, inner_max_iter=sweeps + 1, inner_tol=inner_tol)
+        new_source = self.helper.make_full_fission_source(fluxes['Phi'])
+        int_fiss = self.helper.integrate_flux(new_source)
+        # At convergence (1/k - 1/k_s) int(F phi) = weight
+        k_new = 1/(inv_ks + weight/int_fiss)
+        return fluxes, k_new, new_source / int_fiss
+
+    def count_transport_solves(self):
+        # SAAF sweeps over all angles or Diffusion solves of one group, for
+        # NDA the high order sweeps
+        if isinstance(self.op, NDA):
+            return self.ho_solver.transport_solves
+        return self.transport_solves
+
+    def solve(self, source, ua_bool=False, eigenvalue=False, linear_solver=None,
+              n_workers=None, dsa=False, within_group=None, anderson=None, accel=None):
+        # With eigenvalue, accel selects the eigenvalue solver: None, one of
+        # EIGENVALUE_ACCEL for power_iteration, 'arnoldi' or 'nda'. 'wielandt'
+        # converges the shifted fission source within every group solve, so
+        # with the default within_group='source_iteration' it usually costs
+        # more transport sweeps than plain power iteration (562 against 116
+        # on c5g7 with Diffusion on symmetric_fine). It only pays off for
+        # dominance ratios close to one
         start = time.time()
         phis = np.ones((self.num_groups, self.num_nodes))
+        if linear_solver is not None:
+            self.linear_solver = make_linear_solver(linear_solver)
+            if isinstance(self.op, NDA):
+                self.ho_solver.linear_solver = self.linear_solver
+        if n_workers is not None:
+            self.n_workers = n_workers
         if ua_bool:
             self.ua_bool = True
-        if eigenvalue:
-            fluxes = self.power_iteration(source)
-        else:
-            fluxes = self.solve_outer(source, phis)
+        if anderson is not None:
+            # A history depth or an Anderson accelerator
+            self.anderson = anderson if isinstance(anderson, Anderson) else Anderson(depth=anderson)
+        if within_group is not None:
+            if within_group not in WITHIN_GROUP:
+                raise RuntimeError("Within-group iteration " + str(within_group) + " not supported, "
+                                   "choose from " + ", ".join(WITHIN_GROUP))
+            if within_group == 'gmres' and isinstance(self.op, NDA):
+                raise RuntimeError("The NDA closure is nonlinear, use source iteration")
+            self.within_group = within_group
+        if eigenvalue and accel == 'nda' and self.ua_bool:
+            raise RuntimeError("The NDA eigenvalue iteration does not use upscatter acceleration")
+        if dsa:
+            if not isinstance(self.op, SAAF):
+                raise RuntimeError("DSA is only available for the SAAF formulation")
+            if self.within_group != 'source_iteration':
+                raise RuntimeError("DSA accelerates source iteration only")
+            self.dsa = True
+        self.start_pool()
+        try:
+            if eigenvalue and accel == 'arnoldi':
+                fluxes = self.arnoldi(source)
+            elif eigenvalue and accel == 'nda':
+                fluxes = self.nda_eigenvalue(source)
+            elif eigenvalue:
+                fluxes = self.power_iteration(source, accel=accel)
+            else:
+                fluxes = self.solve_outer(source, phis)
+        finally:
+            self.stop_pool()
         end = time.time()
         print("Runtime:", np.round(end - start, 5), "seconds")
         return fluxes
@@ -19,150 +19,46 @@ class UA():
         return correction
 
     def correction_lhs(self, ho_sols):
-        sparse_matrix = sps.lil_matrix((self.num_nodes, self.num_nodes))
-        ho_phi = np.array([ho_sols[g][0] for g in range(self.num_groups)])
-        ho_psi = np.array([ho_sols[g][1] for g in range(self.num_groups)])
-        # Interpolate Phi
-        triang = self.fegrid.setup_triangulation()
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            midx = elt.mat_id
-            eigs = self.compute_eigenfunction(midx)
-            diffs = np.array([self.mat_data.get_diff(midx, g)*eigs[g] for g in range(self.num_groups)])
-            D = np.sum(diffs)
-            sig_a = self.compute_absorption(midx, eigs)
-            inv_sigt = np.array([self.mat_data.get_inv_sigt(midx, g) for g in range(self.num_groups)])
-            # Determine basis functions for element
-            coef = self.fegrid.basis(e)
-            # Determine Gauss Nodes for element
-            g_nodes = self.fegrid.gauss_nodes(e)
-            # Find Phi at Gauss Nodes
-            phi_vals = self.fegrid.phi_at_gauss_nodes(triang, ho_phi, g_nodes)
-            # Find Psi at Gauss Nodes
-            psi_vals = np.array([self.fegrid.phi_at_gauss_nodes(triang, ho_psi[:, i], g_nodes) for i in range(4)])
-            for n in range(3):
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(bn, g_nodes[i])
-                    for i in range(self.num_gnodes)])
-                n_global = self.fegrid.node(e, n)
-                for ns in range(3):
-                    # Coefficients of basis function
-                    bns = coef[:, ns]
-                    # Array of values of basis function evaluated at gauss nodes
-                    fns_vals = np.array([self.fegrid.evaluate_basis_function(bns, g_nodes[i])
-                        for i in range(self.num_gnodes)])
-                    ns_global = self.fegrid.node(e, ns)
-                    # Get node IDs
-                    nid = n_global.id
-                    nsid = ns_global.id
-                    # Calculate gradients
-                    ngrad = self.fegrid.gradient(e, n)
-                    nsgrad = self.fegrid.gradient(e, ns)
-
-                    # Integrate for A (basis function derivatives)
-                    area = self.fegrid.element_area(e)
-                    inprod = np.dot(ngrad, nsgrad)
-                    A = D * area * inprod
-
-                    # Integrate for B (basis functions multiplied)
-                    integral = self.fegrid.gauss_quad(e, fn_vals*fns_vals)
-                    C = sig_a * integral
-
-                    # Calculate drift_vector
-                    drift_vector = np.zeros((self.num_gnodes, 2))
-                    for g in range(self.num_groups):
-                        drift_vector += self.op.compute_drift_vector(inv_sigt[g],
-                                                diffs[g], ngrad, phi_vals[g],
-                                                psi_vals[:, g])*eigs[g]
-
-                    # Integrate drift_vector@gradient*basis_function
-                    integral = self.fegrid.gauss_quad(e, (drift_vector@ngrad)*fn_vals)
-                    E = integral
-
-                    sparse_matrix[nid, nsid] += A + C + E
-                    if not n_global.is_interior and not ns_global.is_interior:
-                        # Assign boundary id, marks end of region along
-                        # boundary where basis function is nonzero
-                        bid = nsid
-                        # Figure out what boundary you're on
-                        if (nid == nsid) and (self.fegrid.is_corner(nid)):
-                            # If on a corner, figure out what normal we should use
-                            verts = self.fegrid.boundary_nonzero(nid, e)
-                            if verts == -1:  # Means the whole element is a corner
-                                # We have to calculate boundary integral twice,
-                                # once for each other vertex
-                                # Find the other vertices
-                                all_verts = np.array(self.fegrid.element(e).vertices)
-                                vert_local_idx = np.where(all_verts == nid)[0][0]
-                                other_verts = np.delete(all_verts, vert_local_idx)
-                                # Calculate boundary integrals for other vertices
-                                for vtx in other_verts:
-                                    bid = vtx
-                                    xis = self.fegrid.gauss_nodes1d([nid, bid], e)
-                                    basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                                    boundary_integral = self.fegrid.gauss_quad1d(basis_product, [nid, bid], e)
-                                    sparse_matrix[nid,nsid] += boundary_integral
-                                continue
-                            else:
-                                bid = verts[1]
-                        # Check to make sure you're on a boundary
-                        normal = self.fegrid.assign_normal(nid, bid)
-                        if isinstance(normal, int):
-                            continue
-                        # Get Gauss Nodes for the element
-                        xis = self.fegrid.gauss_nodes1d([nid, bid], e)
-                        basis_product = self.fegrid.boundary_basis_product(nid, bid, xis, bn, bns, e)
-                        boundary_integral = self.fegrid.gauss_quad1d(basis_product, [nid, bid], e)
-                        sparse_matrix[nid, nsid] += boundary_integral
-        return sparse_matrix
+        # Eigenfunction weighted diffusion coefficient and absorption cross
+        # section of every material
+        num_mats = self.fegrid.num_mats
+        eigs = np.array([self.compute_eigenfunction(midx) for midx in range(num_mats)])
+        diffs = self.mat_data.D[:num_mats]*eigs
+        D = np.sum(diffs, axis=1)
+        sig_a = np.array([self.compute_absorption(midx, eigs[midx]) for midx in range(num_mats)])
+        # Diffusion, absorption and boundary terms are linear combinations of
+        # the grid's per-material matrices
+        data = (D @ self.fegrid.stiffness_data + sig_a @ self.fegrid.mass_data
+                + self.fegrid.boundary_mass_data)
+        # Drift term, the eigenfunction weighted sum of the group drift vectors
+        midx = self.fegrid.mat_ids
+        drift_vectors = 0
+        for g in range(self.num_groups):
+            # Closure tensor from the angular moments of the group
+            tensor = self.op.drift_tensor(ho_sols[g])
+            group_drift = self.op.compute_drift_vectors(self.mat_data.inv_sigt[midx, g], diffs[midx, g],
+                                                        tensor)
+            drift_vectors += group_drift*eigs[midx, g][:, np.newaxis, np.newaxis, np.newaxis]
+        # Integrate drift_vector@gradient*basis_function, the same for every
+        # column of the element matrix
+        grads = self.fegrid.basis_gradients
+        drift = np.einsum('eq,qn,eqnd,end->en', self.fegrid.gauss_weights,
+                          self.fegrid.quad.shape_values, drift_vectors, grads)
+        local = np.repeat(drift[:, :, np.newaxis], 3, axis=2)
+        data += self.fegrid.element_data(local)
+        return self.fegrid.sparse_matrix(data)
 
     def correction_rhs(self, phis, phis_prev):
+        # Upscattering into every group from the change in flux of the groups
+        # above it, sum over g and g' > g of sig_s[g', g]*M @ (phi - phi_prev)[g'],
+        # with the sum over g folded into one operator per g'
+        num_mats = self.fegrid.num_mats
+        upscatter = np.sum(np.tril(self.mat_data.sig_s[:num_mats], -1), axis=2)
         rhs_at_node = np.zeros(self.num_nodes)
-        triang = self.fegrid.setup_triangulation()
-        for e in range(self.num_elts):
-            elt = self.fegrid.element(e)
-            midx = elt.mat_id
-            coef = self.fegrid.basis(e)
-            g_nodes = self.fegrid.gauss_nodes(e)
-            for n in range(3):
-                n_global = self.fegrid.node(e, n)
-                # Coefficients of basis functions b[0] + b[1]x + b[2]y
-                bn = coef[:, n]
-                # Array of values of basis function evaluated at interior gauss nodes
-                fn_vals = np.array([self.fegrid.evaluate_basis_function(bn, g_nodes[i]) for i in range(self.num_gnodes)])
-                # Get node ids
-                nid = n_global.id
-
-                # Subtract Phi Prevs
-                # Find Phi at Gauss Nodes
-                phi_vals = self.fegrid.phi_at_gauss_nodes(triang, phis_prev, g_nodes)
-                # Multiply Phi & Basis Function
-                product = fn_vals * phi_vals
-                integral = np.array([self.fegrid.gauss_quad(e, product[g]) for g in range(self.num_groups)])
-                ssource = np.sum(np.array([self.partial_scat(midx, integral, g) for g in range(self.num_groups)]))
-                rhs_at_node[nid] -= ssource
-
-                # Add Phi Prevs
-                # Find Phi at Gauss Nodes
-                phi_vals = self.fegrid.phi_at_gauss_nodes(triang, phis, g_nodes)
-                # Multiply Phi & Basis Function
-                product = fn_vals * phi_vals
-                integral = np.array([self.fegrid.gauss_quad(e, product[g]) for g in range(self.num_groups)])
-                ssource = np.sum(np.array([self.partial_scat(midx, integral, g) for g in range(self.num_groups)]))
-                rhs_at_node[nid] += ssource
-
+        for g_prime, data in enumerate(upscatter.T @ self.fegrid.mass_data):
+            rhs_at_node += self.fegrid.sparse_matrix(data) @ (phis[g_prime] - phis_prev[g_prime])
         return rhs_at_node
 
-    def partial_scat(self, midx, phi, group_id):
-        scatmat = self.mat_data.get_sigs(midx)
-        ssource = 0
-        for g_prime in range(group_id+1, self.num_groups):
-            if g_prime != group_id:
-                ssource += scatmat[g_prime, group_id]*phi[g_prime]
-        return ssource
-
     def compute_eigenfunction(self, midx, eig_vals=False):
         scatmat = np.transpose(self.mat_data.get_sigs(midx))
         all_sigts = np.array([self.mat_data.get_sigt(midx, g) for g in range(self.num_groups)])
@@ -0,0 +1,47 @@
+from nose.tools import *
+from numpy.testing import *
+import numpy as np
+
+from gallo.anderson import Anderson
+from gallo.formulations.diffusion import Diffusion
+from gallo.fe import FEGrid
+from gallo.materials import Materials
+from gallo.solvers import Solver
+
+class TestAnderson:
+    @classmethod
+    def setup_class(cls):
+        cls.nodefile = "test/test_inputs/symmetric_fine.node"
+        cls.elefile = "test/test_inputs/symmetric_fine.ele"
+        cls.matfile = "test/test_inputs/3gtest.mat"
+        cls.fegrid = FEGrid(cls.nodefile, cls.elefile)
+        cls.mats = Materials(cls.matfile)
+        cls.op = Diffusion(cls.fegrid, cls.mats)
+
+    def test_linear_fixed_point(self):
+        # x = A x + b with spectral radius 0.9 converges in a few steps once
+        # the history spans the space
+        A = np.diag([0.9, 0.5, -0.3])
+        b = np.ones(3)
+        exact = np.linalg.solve(np.eye(3) - A, b)
+        anderson = Anderson(depth=3)
+        x = np.zeros(3)
+        for i in range(5):
+            x = anderson.update(x, A @ x + b)
+        assert_allclose(x, exact, rtol=1e-10)
+
+    def test_safeguards(self):
+        anderson = Anderson(depth=2)
+        anderson.update(np.ones(2), np.array([1.0, 0.2]))
+        # The mixed iterate would be negative, the plain output is used
+        x = anderson.update(np.array([1.0, 0.1]), np.array([1.0, 0.01]))
+        assert_array_equal(x, [1.0, 0.01])
+        eq_(anderson.restarts, 1)
+        eq_(len(anderson.dF), 0)
+
+    def test_outer_iteration(self):
+        source = np.ones((self.mats.num_groups, self.fegrid.num_elts))
+        plain = Solver(self.op).solve(source)
+        accelerated = Solver(self.op).solve(source, anderson=5)
+        assert_allclose(accelerated['Phi'], plain['Phi'], rtol=1e-5)
+        ok_(accelerated['Outer Iterations'] < plain['Outer Iterations'])
@@ -2,12 +2,13 @@ from nose.tools import *
 from numpy.testing import *
 from nose.plugins.attrib import attr
 import numpy as np
+import itertools as itr
 
 from gallo.formulations.diffusion import Diffusion
 from gallo.fe import FEGrid
 from gallo.materials import Materials
 from gallo.plot import plot
-from gallo.solvers import Solver
+from gallo.solvers import Solver, adaptive_tolerances, valid_shifted_step, OUTER_TOL, INNER_TOL, MAX_OUTER_TOL
 
 class TestDiffusion():
     @classmethod
@@ -45,6 +46,24 @@ class TestDiffusion():
         assert (A!=A.transpose()).nnz==0
         assert (A.diagonal() >= 0).all()
 
+    def test_assembly(self):
+        # Compare the batched assembly with an element by element loop
+        grid = self.symgrid
+        ref = np.zeros((grid.num_nodes, grid.num_nodes))
+        op = Diffusion(grid, self.twoscatmat)
+        A = op.make_lhs(1)
+        for e in range(grid.num_elts):
+            midx = grid.element(e).mat_id
+            D = self.twoscatmat.get_diff(midx, 1)
+            sig_r = self.twoscatmat.get_sigr(midx, 1)
+            for n, ns in itr.product(range(3), repeat=2):
+                nid, nsid = grid.node(e, n).id, grid.node(e, ns).id
+                ref[nid, nsid] += D*grid.element_area(e)*(grid.gradient(e, n)@grid.gradient(e, ns))
+                f_vals = grid.quad.shape_values[:, n]*grid.quad.shape_values[:, ns]
+                ref[nid, nsid] += sig_r*grid.gauss_quad(e, f_vals)
+        ref += grid.boundary_matrix().toarray()
+        assert_allclose(A.toarray(), ref, rtol=1e-13, atol=1e-15)
+
     def test_eigenvalue(self):
         source = np.zeros((self.symfissop.num_groups, self.symfissop.num_elts))
         fluxes = self.symsolver.solve(source, eigenvalue=True)
@@ -52,6 +71,65 @@ class TestDiffusion():
         k = fluxes['k']
         assert_allclose(k, 0.234582, rtol=0.5)
 
+    def test_accelerated_eigenvalue(self):
+        # Reference from a dense generalized eigenvalue solve of the same
+        # discretization
+        source = np.zeros((self.symfissop.num_groups, self.symfissop.num_elts))
+        plain = Solver(self.symfissop).power_iteration(source, tol=1e-6, verbose=False)
+        assert_allclose(plain['k'], 0.2555374, rtol=1e-5)
+        for accel in ['wielandt', 'chebyshev']:
+            fluxes = Solver(self.symfissop).power_iteration(source, tol=1e-6, accel=accel,
+                                                            reference=plain, verbose=False)
+            assert_allclose(fluxes['k'], plain['k'], rtol=1e-5)
+            eq_(fluxes['Transport Solves Saved'], plain['Transport Solves'] - fluxes['Transport Solves'])
+            ok_(fluxes['Power Iterations'] < plain['Power Iterations'])
+            ok_(0 < fluxes['Dominance Ratio'] < 1)
+        ok_(plain['Transport Solves'] >= plain['Power Iterations'])
+        assert_raises(RuntimeError, Solver(self.symfissop).power_iteration, source, accel='lanczos')
+
+    def test_supercritical_wielandt(self):
+        # k above the shifted eigenvalue of the initial guess, 1.2
+        op = Diffusion(self.symgrid, Materials("test/test_inputs/supercritical.mat"))
+        source = np.zeros((op.num_groups, op.num_elts))
+        plain = Solver(op).power_iteration(source, tol=1e-6, verbose=False)
+        assert_allclose(plain['k'], 1.5332240, rtol=1e-6)
+        fluxes = Solver(op).power_iteration(source, tol=1e-6, accel='wielandt', verbose=False)
+        assert_allclose(fluxes['k'], plain['k'], rtol=1e-6)
+        ok_(fluxes['Power Iterations'] < plain['Power Iterations'])
+        # Shifted steps whose k_s is not safely above the eigenvalue
+        fiss_source = np.ones((1, op.num_elts))
+        ok_(valid_shifted_step(1.5, fiss_source, 1/1.8, 0.2))
+        ok_(not valid_shifted_step(1.75, fiss_source, 1/1.8, 0.2))
+        ok_(not valid_shifted_step(np.nan, fiss_source, 1/1.8, 0.2))
+        ok_(not valid_shifted_step(1.5, -fiss_source, 1/1.8, 0.2))
+
+    def test_inexact_power_iteration(self):
+        mats = Materials("test/test_inputs/c5g7.mat")
+        op = Diffusion(self.symfissop.fegrid, mats)
+        source = np.zeros((op.num_groups, op.num_elts))
+        exact = Solver(op).power_iteration(source, tol=1e-6, verbose=False)
+        for kwargs in [{'sweeps': 1}, {'adaptive': True}, {'sweeps': 2, 'adaptive': True}]:
+            fluxes = Solver(op).power_iteration(source, tol=1e-6, verbose=False, **kwargs)
+            assert_allclose(fluxes['k'], exact['k'], rtol=1e-6)
+            ok_(fluxes['Transport Solves'] < exact['Transport Solves'])
+        eq_(adaptive_tolerances(1), (MAX_OUTER_TOL, MAX_OUTER_TOL*INNER_TOL/OUTER_TOL))
+        eq_(adaptive_tolerances(1e-9), (OUTER_TOL, INNER_TOL))
+
+    def test_arnoldi(self):
+        source = np.zeros((self.symfissop.num_groups, self.symfissop.num_elts))
+        solver = Solver(self.symfissop)
+        fluxes = solver.arnoldi(source, num_modes=3, verbose=False)
+        assert_allclose(fluxes['k'], 0.2555374, rtol=1e-5)
+        harmonics = np.abs(fluxes['Harmonics'])
+        ok_(np.all(np.diff(harmonics) < 0))
+        # The fundamental fission source is positive and normalized
+        fund = fluxes['Fission Sources'][0]
+        ok_(np.all(fund > 0))
+        assert_allclose(solver.helper.integrate_flux(fund), 1, rtol=1e-10)
+        assert_allclose(solver.helper.make_full_fission_source(fluxes['Phi']), fund, rtol=1e-4)
+        ok_(fluxes['Operator Applications'] < 30)
+        assert_raises(RuntimeError, solver.arnoldi, source, num_modes=0)
+
     @attr('slow')
     def test_two_group(self):
         source = np.ones((self.twop.num_groups, self.twop.num_elts))
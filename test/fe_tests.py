@@ -1,8 +1,11 @@
+from math import factorial
+
 from nose.tools import *
 from numpy.testing import *
 import numpy as np
+import scipy.sparse as sps
 
-from gallo.fe import FEGrid, setup_ang_quad
+from gallo.fe import FEGrid, TriQuadrature, TRI_QUAD_RULES, setup_ang_quad, find_opposite_angles
 
 class TestFe:
     @classmethod
@@ -148,3 +151,166 @@ class TestFe:
         assert_array_equal(normal, [0, -1])
         normal = self.fegrid.assign_normal(4, 8)
         eq_(normal, -1)
+
+    def test_geometry_arrays(self):
+        assert_array_equal(self.stdgrid.coords, [[0, 0], [1, 0], [1, 1], [0, 1]])
+        assert_array_equal(self.stdgrid.connectivity, [[3, 0, 1], [1, 2, 3]])
+        assert_array_equal(self.stdgrid.mat_ids, [0, 0])
+        assert_array_equal(self.stdgrid.is_boundary, [True, True, True, True])
+        eq_(self.fegrid.is_boundary.sum(), 6)
+        assert_array_equal(self.stdgrid.areas, [.5, .5])
+        assert_array_equal(self.stdgrid.jacobians[0], [[1, 0], [0, 1]])
+        # The jacobians map the quadrature points onto the gauss points
+        grid = self.fegrid
+        origins = grid.coords[grid.connectivity[:, 1]]
+        mapped = origins[:, np.newaxis, :] + np.einsum('eij,qj->eqi', grid.jacobians, grid.quad.points)
+        assert_array_almost_equal(mapped, grid.gauss_points, 12)
+
+    def test_basis_gradients(self):
+        # Compare the bulk gradients against the geometric formula
+        for e in range(self.fegrid.num_elts):
+            vertices = self.fegrid.connectivity[e]
+            for n in range(3):
+                xbase = self.fegrid.coords[vertices[n]]
+                dx = np.array([self.fegrid.coords[vertices[(n + i + 1) % 3]] - xbase
+                               for i in range(2)])
+                det = dx[0, 0] * dx[1, 1] - dx[1, 0] * dx[0, 1]
+                grad = np.array([-(dx[1, 1] - dx[0, 1]) / det, (dx[1, 0] - dx[0, 0]) / det])
+                assert_allclose(self.fegrid.basis_gradients[e, n], grad)
+
+    def test_quad_rules(self):
+        # Each rule integrates monomials u^a v^b up to its order exactly
+        for order in TRI_QUAD_RULES:
+            quad = TriQuadrature(order)
+            u, v = quad.points[:, 0], quad.points[:, 1]
+            for a in range(order + 1):
+                for b in range(order + 1 - a):
+                    exact = factorial(a)*factorial(b)/factorial(a + b + 2)
+                    assert_almost_equal(quad.integrate(.5, u**a * v**b), exact, 12)
+            assert_array_almost_equal(quad.shape_values.sum(axis=1), 1, 12)
+        assert_raises(RuntimeError, TriQuadrature, 9)
+        assert_raises(RuntimeError, TriQuadrature.from_num_points, 5)
+
+    def test_batched_gauss_points(self):
+        grid = FEGrid(self.nodefile, self.elefile, num_gauss_nodes=6)
+        eq_(grid.quad.order, 4)
+        eq_(grid.gauss_points.shape, (grid.num_elts, 6, 2))
+        for e in range(grid.num_elts):
+            coef = grid.basis(e)
+            g_nodes = grid.gauss_nodes(e)
+            eq_(len(g_nodes), grid.num_gauss_nodes)
+            vals = np.array([[grid.evaluate_basis_function(coef[:, n], g) for n in range(3)]
+                             for g in g_nodes])
+            assert_array_almost_equal(vals, grid.quad.shape_values, 12)
+            assert_almost_equal(grid.gauss_weights[e].sum(), grid.element_area(e), 12)
+
+    def test_boundary_edges_table(self):
+        bdy = self.fegrid.boundary
+        eq_(bdy.num_edges, 6)
+        assert_array_almost_equal(np.sort(bdy.lengths), [.5, .5, .5, .5, 1, 1])
+        for b in range(bdy.num_edges):
+            normal = self.fegrid.assign_normal(*bdy.nodes[b])
+            assert_array_equal(bdy.normals[b], normal)
+            vertices = self.fegrid.connectivity[bdy.elts[b], bdy.local_verts[b]]
+            assert_array_equal(vertices, bdy.nodes[b])
+        # Two point rule, so the edge points sit at the 1D Gauss nodes
+        nodes05 = np.array([[(-(.5-0)/2*1/np.sqrt(3)+(.5+0)/2), 0],
+                            [((.5-0)/2*1/np.sqrt(3)+(.5+0)/2), 0]])
+        b = np.where((bdy.nodes == [0, 5]).all(axis=1))[0][0]
+        assert_array_almost_equal(bdy.gauss_points[b], nodes05)
+
+    def test_boundary_matrix(self):
+        B = self.stdgrid.boundary_matrix().toarray()
+        true_B = np.array([[2/3, 1/6, 0, 1/6],
+                           [1/6, 2/3, 1/6, 0],
+                           [0, 1/6, 2/3, 1/6],
+                           [1/6, 0, 1/6, 2/3]])
+        assert_array_almost_equal(B, true_B)
+        # Integrating one over the boundary gives the perimeter
+        assert_almost_equal(self.fegrid.boundary_matrix().sum(), 4)
+        flux = np.random.rand(self.fegrid.num_nodes)
+        edge_flux = self.fegrid.edge_values(flux)
+        assert_array_almost_equal(edge_flux.sum(axis=1), flux[self.fegrid.boundary.nodes].sum(axis=1))
+
+    def test_values_at_gauss_nodes(self):
+        flux = np.random.rand(2, self.fegrid.num_nodes)
+        at_gauss = self.fegrid.values_at_gauss_nodes(flux)
+        eq_(at_gauss.shape, (2, self.fegrid.num_elts, self.fegrid.num_gauss_nodes))
+        triang = self.fegrid.setup_triangulation()
+        for e in range(self.fegrid.num_elts):
+            g_nodes = self.fegrid.gauss_nodes(e)
+            interp = self.fegrid.phi_at_gauss_nodes(triang, flux, g_nodes)
+            assert_array_almost_equal(at_gauss[:, e], interp, 12)
+        # Leading axes are kept, e.g. groups and angles of the angular flux
+        psi = np.random.rand(2, 4, self.fegrid.num_nodes)
+        psi_at_gauss = self.fegrid.values_at_gauss_nodes(psi)
+        assert_array_almost_equal(psi_at_gauss[1, 3], self.fegrid.values_at_gauss_nodes(psi[1, 3]))
+
+    def test_sparsity_pattern(self):
+        grid = self.fegrid
+        local = np.random.rand(grid.num_elts, 3, 3)
+        # Scattering into the cached pattern matches a from-scratch assembly
+        coo = sps.coo_matrix((local.ravel(), (grid.elt_rows, grid.elt_cols)),
+                             shape=(grid.num_nodes, grid.num_nodes))
+        A = grid.assemble(local)
+        assert_array_almost_equal(A.toarray(), coo.toarray())
+        B = grid.boundary_matrix()
+        # Every operator shares the index arrays, only the data changes
+        assert np.shares_memory(A.indices, B.indices)
+        assert np.shares_memory(A.indptr, B.indptr)
+        eq_(len(A.data), grid.nnz)
+        assert_raises(RuntimeError, grid.nnz_index, np.array([grid.num_nodes - 1]), np.array([grid.num_nodes]))
+
+    def test_material_matrices(self):
+        grid = self.fegrid
+        eq_(grid.stiffness_data.shape, (grid.num_mats, grid.nnz))
+        # Summing over materials recovers the matrices of the whole grid
+        assert_array_almost_equal(grid.stiffness_data.sum(axis=0),
+                                  grid.element_data(grid.stiffness_elts))
+        assert_array_almost_equal(grid.mass_data.sum(axis=0),
+                                  grid.element_data(grid.mass_elts))
+        # Each material only touches the nodes of its own elements
+        for m in range(grid.num_mats):
+            M = grid.sparse_matrix(grid.mass_data[m])
+            assert_almost_equal(M.sum(), grid.areas[grid.mat_ids == m].sum())
+
+    def test_from_arrays(self):
+        grid = FEGrid.from_arrays(self.fegrid.coords, self.fegrid.connectivity,
+                                  self.fegrid.mat_ids, self.fegrid.is_boundary, sn_ord=4)
+        eq_(grid.num_nodes, self.fegrid.num_nodes)
+        eq_(grid.num_angs, 12)
+        eq_(grid.element(3), self.fegrid.element(3))
+        eq_(grid.node(5), self.fegrid.node(5))
+        eq_((grid.xmin, grid.xmax, grid.ymin, grid.ymax),
+            (self.fegrid.xmin, self.fegrid.xmax, self.fegrid.ymin, self.fegrid.ymax))
+        assert_array_equal(grid.mass_data, self.fegrid.mass_data)
+
+    def test_opposite_angles(self):
+        for sn_ord in [2, 4, 8]:
+            angs, weights = setup_ang_quad(sn_ord)
+            opposite = find_opposite_angles(angs)
+            assert_array_almost_equal(angs[opposite], -angs, 12)
+            assert_array_equal(opposite[opposite], np.arange(len(angs)))
+        assert_array_equal(find_opposite_angles(np.array([[1, 0], [0, 1]])), [-1, -1])
+
+    def test_load_matrices(self):
+        grid = self.fegrid
+        ones = np.ones(grid.num_elts)
+        assert_almost_equal(grid.load_matrix.sum(), grid.areas.sum())
+        for d in range(2):
+            # The basis functions sum to one, so their gradients sum to zero
+            assert_array_almost_equal(grid.gradient_load[d].sum(axis=0).A1, np.zeros(grid.num_elts))
+            G = grid.sparse_matrix(grid.gradient_data[d].sum(axis=0))
+            assert_array_almost_equal(G @ np.ones(grid.num_nodes), grid.gradient_load[d] @ ones)
+
+    def test_linear_operator(self):
+        # The matrix-free operator applies the same matrix as assembling the
+        # element and boundary matrices
+        grid = self.stdgrid
+        local = np.random.rand(grid.num_elts, 3, 3)
+        coefs = np.random.rand(grid.boundary.num_edges, 2)
+        A = grid.assemble(local) + grid.boundary_matrix(coefs)
+        op = grid.linear_operator(local, grid.boundary_local(coefs))
+        x = np.random.rand(grid.num_nodes)
+        assert_allclose(op @ x, A @ x, rtol=1e-12)
+        assert_allclose(op.diagonal(), A.diagonal(), rtol=1e-12)
@@ -37,3 +37,25 @@ class TestHelpers():
         #                      (flux[i, 1] + flux[i, 2] + flux[i, 3])/3 for i in range(g)])
         true_integral = np.sum(flux)*0.5
         assert_almost_equal(integral, true_integral, decimal=10)
+
+    def test_scattering_matrices(self):
+        grid = FEGrid("test/test_inputs/symmetric.node", "test/test_inputs/symmetric.ele")
+        mats = Materials("test/test_inputs/3gtest.mat")
+        helper = Helper(grid, mats)
+        phi = np.ones((3, grid.num_nodes))
+        for g in range(3):
+            scattering = helper.scattering_matrices(g)
+            ssource = helper.scattering_source(scattering, phi)
+            # For a flat flux the source is the integral of the basis functions
+            # times the scattering cross sections from the other groups
+            sig_s = np.sum(mats.sig_s[grid.mat_ids, :, g], axis=1) - mats.sig_s[grid.mat_ids, g, g]
+            assert_array_almost_equal(ssource, grid.load_matrix @ sig_s)
+            ok_(scattering[g].count_nonzero() == 0)
+            self_scatter = helper.scattering_matrices(g, self_scatter=True)
+            assert_array_almost_equal(helper.scattering_source(self_scatter, phi) - ssource,
+                                      grid.load_matrix @ mats.sig_s[grid.mat_ids, g, g])
+            # The right hand side adds the fixed source to the cached operators
+            source = np.ones((3, grid.num_elts))
+            assert_array_almost_equal(helper.make_rhs(g, source, phi),
+                                      ssource + grid.load_matrix @ source[g])
+        eq_(sorted(helper.scattering_cache), [0, 1, 2])
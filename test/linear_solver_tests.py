@@ -0,0 +1,126 @@
+from nose.tools import *
+from numpy.testing import *
+import numpy as np
+
+from gallo.formulations.diffusion import Diffusion
+from gallo.formulations.saaf import SAAF
+from gallo.fe import FEGrid
+from gallo.materials import Materials
+from gallo.linear_solvers import LinearSolver, FactorizationCache, make_linear_solver, krylov_kwargs, METHODS
+from gallo.solvers import Solver
+
+class TestLinearSolvers:
+    @classmethod
+    def setup_class(cls):
+        cls.nodefile = "test/test_inputs/symmetric_fine.node"
+        cls.elefile = "test/test_inputs/symmetric_fine.ele"
+        cls.matfile = "test/test_inputs/scattering2g.mat"
+        cls.fegrid = FEGrid(cls.nodefile, cls.elefile)
+        cls.mats = Materials(cls.matfile)
+        cls.diffop = Diffusion(cls.fegrid, cls.mats)
+        cls.saafop = SAAF(cls.fegrid, cls.mats)
+
+    def test_methods_agree(self):
+        A = self.saafop.make_lhs(np.array(self.fegrid.angs[1]), 0)
+        b = np.random.rand(self.fegrid.num_nodes)
+        ref = np.linalg.solve(A.toarray(), b)
+        for method in METHODS:
+            x = LinearSolver(method, tol=1e-12).solve(A, b, symmetric=True)
+            assert_allclose(x, ref, rtol=1e-8)
+
+    def test_auto(self):
+        solver = LinearSolver(direct_max_nodes=10)
+        eq_(solver.choose_method(10, True), 'direct')
+        eq_(solver.choose_method(11, True), 'cg')
+        eq_(solver.choose_method(11, False), 'gmres')
+        A = self.diffop.make_lhs(1)
+        b = np.ones(self.fegrid.num_nodes)
+        x = solver.solve(A, b, symmetric=True)
+        assert_allclose(A @ x, b, rtol=1e-8)
+        ok_(solver.iterations > 0)
+
+    def test_krylov_kwargs(self):
+        # Older SciPy releases take tol and have no callback_type
+        def old_gmres(A, b, x0=None, tol=1e-5, restart=None, maxiter=None, M=None,
+                      callback=None, atol=None):
+            pass
+        def new_gmres(A, b, x0=None, *, rtol=1e-5, atol=0, restart=None, maxiter=None, M=None,
+                      callback=None, callback_type=None):
+            pass
+        eq_(krylov_kwargs(old_gmres, 1e-8), {'tol': 1e-8, 'atol': 0})
+        eq_(krylov_kwargs(new_gmres, 1e-8), {'rtol': 1e-8, 'atol': 0, 'callback_type': 'pr_norm'})
+
+    def test_make_linear_solver(self):
+        eq_(make_linear_solver(None).method, 'auto')
+        eq_(make_linear_solver('gmres').method, 'gmres')
+        solver = LinearSolver('cg')
+        ok_(make_linear_solver(solver) is solver)
+        assert_raises(RuntimeError, LinearSolver, 'jacobi')
+        assert_raises(RuntimeError, LinearSolver, 'cg', preconditioner='ilu')
+
+    def test_factorization_cache(self):
+        A = self.diffop.make_lhs(0)
+        b = np.ones(self.fegrid.num_nodes)
+        cache = FactorizationCache()
+        x = cache.solve(('Diffusion', 0, None), lambda: A, b)
+        assert_allclose(A @ x, b, rtol=1e-10)
+        # A repeat solve does not assemble the operator again
+        y = cache.solve(('Diffusion', 0, None), lambda: None, 2*b)
+        assert_allclose(y, 2*x)
+        eq_((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+        # Least recently used entries are evicted to stay within the budget
+        small = FactorizationCache(max_bytes=2.5*cache.nbytes)
+        small.solve('a', lambda: A, b)
+        small.solve('b', lambda: A, b)
+        small.solve('a', lambda: A, b)
+        small.solve('c', lambda: A, b)
+        ok_('a' in small and 'b' not in small and 'c' in small)
+        eq_(small.stats()["evictions"], 1)
+        ok_(small.nbytes <= small.max_bytes)
+        small.discard('a')
+        ok_('a' not in small)
+        eq_(small.nbytes, small.entries['c'][1])
+
+    def test_solver_cache(self):
+        source = np.ones((self.mats.num_groups, self.fegrid.num_elts))
+        solver = Solver(self.diffop)
+        phis = solver.solve_outer(source, np.ones((2, self.fegrid.num_nodes)), verbose=False)['Phi']
+        stats = solver.factorizations.stats()
+        eq_(stats['entries'], self.mats.num_groups)
+        ok_(stats['hits'] > stats['misses'])
+        uncached = Solver(self.diffop, cache_bytes=0)
+        ok_(uncached.factorizations is None)
+        ref = uncached.solve_outer(source, np.ones((2, self.fegrid.num_nodes)), verbose=False)['Phi']
+        assert_allclose(phis, ref, rtol=1e-10)
+
+    def test_warm_start(self):
+        source = np.ones((self.mats.num_groups, self.fegrid.num_elts))
+        solver = Solver(self.diffop, linear_solver=LinearSolver('cg', tol=1e-12))
+        phis = solver.solve_outer(source, np.ones((2, self.fegrid.num_nodes)), verbose=False)['Phi']
+        # Iterative methods keep the assembled operators and start from the
+        # previous solution, both within the cache budget
+        ok_(('warm start', ('Diffusion', 1, None)) in solver.factorizations)
+        ok_(('operator', ('Diffusion', 1, None)) in solver.factorizations)
+        small = Solver(self.diffop, linear_solver=LinearSolver('cg', tol=1e-12),
+                       cache_bytes=8*self.fegrid.num_nodes)
+        small.solve_outer(source, np.ones((2, self.fegrid.num_nodes)), verbose=False)
+        eq_(len(small.factorizations), 1)
+        ok_(small.factorizations.nbytes <= small.factorizations.max_bytes)
+        ref = Solver(self.diffop).solve_outer(source, np.ones((2, self.fegrid.num_nodes)), verbose=False)['Phi']
+        assert_allclose(phis, ref, rtol=1e-8)
+
+    def test_matrix_free(self):
+        source = np.ones((self.mats.num_groups, self.fegrid.num_elts))
+        phi_prev = np.ones((2, self.fegrid.num_nodes))
+        ref = Solver(self.saafop).get_scalar_flux(1, source, phi_prev)['Phi']
+        linear_solver = LinearSolver('cg', tol=1e-12, preconditioner='jacobi')
+        solver = Solver(self.saafop, linear_solver=linear_solver, matrix_free=True)
+        assert_allclose(solver.get_scalar_flux(1, source, phi_prev)['Phi'], ref, rtol=1e-8)
+        # Nothing is assembled or factored, only the warm starts are kept
+        ok_(len(solver.factorizations) > 0)
+        ok_(all(key[0] == 'warm start' for key in solver.factorizations.entries))
+        direct = Solver(self.saafop, linear_solver='splu', matrix_free=True)
+        assert_raises(RuntimeError, direct.get_scalar_flux, 1, source, phi_prev)
+        A = self.diffop.lhs_operator(0)
+        assert_raises(RuntimeError, LinearSolver('direct').solve, A, np.ones(self.fegrid.num_nodes))
+        eq_(LinearSolver().choose_method(self.fegrid.num_nodes, True, matrix_free=True), 'cg')
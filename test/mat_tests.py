@@ -45,3 +45,11 @@ class TestMaterials:
         mats2 = np.array([[3, 0],
                           [0, 1]])
         assert_array_equal(mats1, mats2)
+
+    def test_from_arrays(self):
+        mats = Materials.from_arrays(self.materials.arrays(), self.materials.names)
+        eq_(mats.num_mats, 2)
+        eq_(mats.get_num_groups(), self.materials.get_num_groups())
+        eq_(mats.get_name(1), "'reflector'")
+        assert_array_equal(mats.get_sigs(1), self.materials.get_sigs(1))
+        eq_(mats.get_sigr(0, 1), self.materials.get_sigr(0, 1))
@@ -3,7 +3,7 @@ from numpy.testing import *
 from nose.plugins.attrib import attr
 import numpy as np
 
-from gallo.formulations.nda import NDA
+from gallo.formulations.nda import NDA, AngularMoments
 from gallo.formulations.saaf import SAAF
 from gallo.fe import FEGrid
 from gallo.materials import Materials
@@ -82,6 +82,72 @@ class TestNDA:
         phis = fluxes['Phi']
         gold_phis = np.loadtxt("test/test_outputs/tgnda2g.out")
         assert_array_almost_equal(phis, gold_phis, decimal=2)
+
+    def test_batched_closure(self):
+        # Batched drift vectors and kappa match the pointwise closures
+        grid = self.symgrid
+        psi = np.random.rand(grid.num_angs, grid.num_nodes) + 1
+        phi = grid.weights @ psi
+        moments = AngularMoments.from_psi(grid, psi)
+        assert_allclose(moments.phi, phi, rtol=1e-14)
+        phi_at_gauss = grid.values_at_gauss_nodes(phi)
+        psi_at_gauss = grid.values_at_gauss_nodes(psi)
+        tensor = self.nop.drift_tensor(moments)
+        inv_sigt = np.random.rand(grid.num_elts)
+        D = np.random.rand(grid.num_elts)
+        drift = self.nop.compute_drift_vectors(inv_sigt, D, tensor)
+        for e in range(0, grid.num_elts, 7):
+            for n in range(3):
+                ref = self.nop.compute_drift_vector(inv_sigt[e], D[e], grid.gradient(e, n),
+                                                    phi_at_gauss[e], psi_at_gauss[:, e])
+                assert_allclose(drift[e, :, n], ref, rtol=1e-12, atol=1e-14)
+        kappa = self.nop.compute_kappas(moments)
+        phi_bd, psi_bd = grid.edge_values(phi), grid.edge_values(psi)
+        for b in range(grid.boundary.num_edges):
+            ref = self.nop.compute_kappa(grid.boundary.normals[b], phi_bd[b], psi_bd[:, b])
+            assert_allclose(kappa[b], ref, rtol=1e-12)
+
+    def test_ho_moments(self):
+        # Moments accumulated during the high order solve match the moments
+        # of the stored angular fluxes
+        source = 10*np.ones((self.oneop.num_groups, self.oneop.num_elts))
+        phi_prev = np.ones((1, self.symgrid.num_nodes))
+        ho_solver = Solver(self.onesolv.ho_op)
+        moments = ho_solver.get_scalar_flux(0, source, phi_prev, moments=True)['Moments']
+        fluxes = ho_solver.get_scalar_flux(0, source, phi_prev)
+        ref = AngularMoments.from_psi(self.symgrid, fluxes['Psi'])
+        assert_allclose(moments.phi, fluxes['Phi'], rtol=1e-12)
+        assert_allclose(moments.tensor, ref.tensor, rtol=1e-12, atol=1e-14)
+        assert_allclose(moments.boundary, ref.boundary, rtol=1e-12, atol=1e-14)
+
+    def test_persistent_ho_solver(self):
+        solver = Solver(self.oneop)
+        ok_(solver.ho_solver.factorizations is solver.factorizations)
+        source = 10*np.ones((self.oneop.num_groups, self.oneop.num_elts))
+        phi_prev = np.ones((1, self.symgrid.num_nodes))
+        solver.solve_in_group(source, 0, phi_prev, verbose=False)
+        # The SAAF operators of every angle are factored once for all the
+        # within-group iterations
+        stats = solver.factorizations.stats()
+        eq_(stats['misses'], self.symgrid.num_angs)
+        ok_(stats['hits'] > stats['misses'])
+
+    def test_nda_eigenvalue(self):
+        fissmat = Materials("test/test_inputs/fissiontest.mat")
+        fissop = NDA(self.symgrid, fissmat)
+        source = np.zeros((fissop.num_groups, fissop.num_elts))
+        ref = Solver(fissop).power_iteration(source, tol=1e-6, verbose=False)
+        fluxes = Solver(fissop).nda_eigenvalue(source, tol=1e-6, verbose=False)
+        assert_allclose(fluxes['k'], ref['k'], rtol=1e-5)
+        # The eigenvalue is converged on the low order system, the high
+        # order sweeps only update the closures
+        ok_(fluxes['Transport Solves'] < ref['Transport Solves'])
+        ok_(fluxes['LO Iterations'] > fluxes['Power Iterations'])
+        assert_raises(RuntimeError, Solver(SAAF(self.symgrid, fissmat)).nda_eigenvalue, source)
+        # Opt in only, upscatter acceleration keeps the nested power iteration
+        assert_raises(RuntimeError, Solver(fissop).solve, source, ua_bool=True, eigenvalue=True,
+                      accel='nda')
+
     # def kappa_test(self):
     #     normal = np.array([0, 1])
     #     psi = np.ones((4, 2))
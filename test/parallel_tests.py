@@ -0,0 +1,77 @@
+from nose.tools import *
+from numpy.testing import *
+import numpy as np
+
+from gallo.formulations.saaf import SAAF
+from gallo.fe import FEGrid
+from gallo.materials import Materials
+from nose import SkipTest
+try:
+    from gallo.parallel import SharedArrays, attach
+except ImportError:
+    # multiprocessing.shared_memory is new in Python 3.8
+    raise SkipTest("Parallel angle solves need Python 3.8")
+from gallo.solvers import Solver
+
+class TestParallel:
+    @classmethod
+    def setup_class(cls):
+        cls.nodefile = "test/test_inputs/std3.node"
+        cls.elefile = "test/test_inputs/std3.ele"
+        cls.matfile = "test/test_inputs/scattering1g.mat"
+        cls.fegrid = FEGrid(cls.nodefile, cls.elefile, sn_ord=4)
+        cls.mats = Materials(cls.matfile)
+        cls.op = SAAF(cls.fegrid, cls.mats)
+
+    def test_shared_arrays(self):
+        shared = SharedArrays({'a': np.arange(6.0).reshape(2, 3), 'b': np.array([1, 2])})
+        blocks, arrays = attach(shared.specs)
+        assert_array_equal(arrays['a'], np.arange(6.0).reshape(2, 3))
+        # Writes are seen by every process attached to the block
+        arrays['b'][1] = 5
+        eq_(shared['b'][1], 5)
+        del arrays
+        for block in blocks.values():
+            block.close()
+        shared.close()
+
+    def test_parallel_angles(self):
+        source = 10*np.ones((1, self.fegrid.num_elts))
+        serial = Solver(self.op).solve(source)
+        parallel = Solver(self.op, n_workers=3)
+        fluxes = parallel.solve(source)
+        # Angles are reduced in a fixed order, so the results agree exactly
+        assert_array_equal(fluxes['Phi'], serial['Phi'])
+        assert_array_equal(fluxes['Psi'], serial['Psi'])
+        ok_(parallel.angle_pool is None)
+
+    def test_parallel_moments(self):
+        source = 10*np.ones((1, self.fegrid.num_elts))
+        phi_prev = np.ones((1, self.fegrid.num_nodes))
+        serial = Solver(self.op).get_scalar_flux(0, source, phi_prev, moments=True)['Moments']
+        parallel = Solver(self.op, n_workers=3)
+        parallel.start_pool()
+        try:
+            moments = parallel.get_scalar_flux(0, source, phi_prev, moments=True)['Moments']
+        finally:
+            parallel.stop_pool()
+        # Blocks are summed in a different order than the serial angles
+        assert_allclose(moments.phi, serial.phi, rtol=1e-12)
+        assert_allclose(moments.tensor, serial.tensor, rtol=1e-12, atol=1e-14)
+        assert_allclose(moments.boundary, serial.boundary, rtol=1e-12, atol=1e-14)
+
+    def test_worker_caches(self):
+        source = 10*np.ones((1, self.fegrid.num_elts))
+        phi_prev = np.ones((1, self.fegrid.num_nodes))
+        parallel = Solver(self.op, n_workers=3)
+        parallel.start_pool()
+        try:
+            for i in range(2):
+                parallel.get_scalar_flux(0, source, phi_prev)
+            stats = parallel.angle_pool.worker_stats
+        finally:
+            parallel.stop_pool()
+        # Every worker keeps the factorizations of its angles for later
+        # sweeps, which angles a worker gets can change between sweeps
+        eq_(len(stats), 3)
+        ok_(all(s is not None and s['entries'] > 0 for s in stats))
@@ -5,6 +5,7 @@ import numpy as np
 import itertools as itr
 
 from gallo.formulations.saaf import SAAF
+from gallo.formulations.diffusion import Diffusion
 from gallo.fe import FEGrid
 from gallo.materials import Materials
 from gallo.solvers import Solver
@@ -90,6 +91,76 @@ class TestSAAF:
         A = self.op.make_lhs(np.array([ang_one, ang_two]), 0)
         ok_(np.allclose(A.A, A.transpose().A, rtol=1e-12))
 
+    def test_assembly(self):
+        # Compare the direction tensor decomposition with an element by element loop
+        grid = self.origrid
+        op = self.twop
+        for ang, g in itr.product(grid.angs[:3], range(2)):
+            A = op.make_lhs(np.array(ang), g)
+            ref = np.zeros((grid.num_nodes, grid.num_nodes))
+            for e in range(grid.num_elts):
+                midx = grid.element(e).mat_id
+                inv_sigt = self.twoscatmat.get_inv_sigt(midx, g)
+                sig_t = self.twoscatmat.get_sigt(midx, g)
+                for n, ns in itr.product(range(3), repeat=2):
+                    nid, nsid = grid.node(e, n).id, grid.node(e, ns).id
+                    ref[nid, nsid] += inv_sigt*grid.element_area(e)*(ang@grid.gradient(e, n))*(ang@grid.gradient(e, ns))
+                    f_vals = grid.quad.shape_values[:, n]*grid.quad.shape_values[:, ns]
+                    ref[nid, nsid] += sig_t*grid.gauss_quad(e, f_vals)
+            ref += grid.boundary_matrix(np.maximum(grid.boundary.normals@ang, 0)).toarray()
+            assert_allclose(A.toarray(), ref, rtol=1e-12, atol=1e-14)
+
+    def test_opposite_pairs(self):
+        grid = self.origrid
+        for i, j in enumerate(grid.opposite_angs):
+            ang = np.array(grid.angs[i])
+            lhs, lhs_opposite = self.twop.make_lhs_pair(ang, 1)
+            assert_allclose(lhs.toarray(), self.twop.make_lhs(ang, 1).toarray(), rtol=1e-14)
+            assert_allclose(lhs_opposite.toarray(), self.twop.make_lhs(grid.angs[j], 1).toarray(),
+                            rtol=1e-12, atol=1e-14)
+
+    def test_rhs_all(self):
+        grid = self.origrid
+        source = np.random.rand(2, grid.num_elts)
+        phi_prev = np.random.rand(2, grid.num_nodes)
+        rhs = self.twop.make_rhs_all(0, source, phi_prev)
+        eq_(rhs.shape, (grid.num_angs, grid.num_nodes))
+        for i, ang in enumerate(grid.angs):
+            assert_allclose(rhs[i], self.twop.make_rhs(0, source, ang, i, phi_prev), rtol=1e-12, atol=1e-15)
+        rhs = self.twop.make_rhs_all(0, source, phi_prev, grid.angs[[3, 1]])
+        assert_allclose(rhs[0], self.twop.make_rhs(0, source, grid.angs[3], 3, phi_prev), rtol=1e-12, atol=1e-15)
+
+    def test_dsa(self):
+        grid = self.symgrid
+        mats = Materials("test/test_inputs/scattering1g.mat")
+        source = 10*np.ones((1, grid.num_elts))
+        plain = Solver(SAAF(grid, mats)).solve(source)
+        accelerated = Solver(SAAF(grid, mats)).solve(source, dsa=True)
+        assert_allclose(accelerated['Phi'], plain['Phi'], rtol=1e-6)
+        ok_(accelerated['Iterations'][0] < plain['Iterations'][0]/2)
+        assert_raises(RuntimeError, Solver(Diffusion(grid, mats)).solve, source, dsa=True)
+
+    def test_within_group_gmres(self):
+        grid = self.symgrid
+        mats = Materials("test/test_inputs/scattering1g.mat")
+        source = 10*np.ones((1, grid.num_elts))
+        plain = Solver(SAAF(grid, mats)).solve(source)
+        krylov = Solver(SAAF(grid, mats)).solve(source, within_group='gmres')
+        assert_allclose(krylov['Phi'], plain['Phi'], rtol=1e-6)
+        assert_allclose(krylov['Psi'], plain['Psi'], rtol=1e-6)
+        ok_(krylov['Iterations'][0] < plain['Iterations'][0]/2)
+        # Residual history of the one within-group solve
+        residuals = krylov['Residuals'][0][0]
+        ok_(residuals[-1] < 1e-8 and residuals[-1] < residuals[0])
+        assert_raises(RuntimeError, Solver(SAAF(grid, mats)).solve, source, within_group='jacobi')
+        # max_iter bounds the GMRES iterations, not the restart cycles, with
+        # a residual evaluation per cycle and two more transport solves
+        bounded = Solver(SAAF(grid, mats))
+        bounded.within_group = 'gmres'
+        fluxes = bounded.solve_in_group(source, 0, np.ones((1, grid.num_nodes)), max_iter=5,
+                                        tol=1e-14, verbose=False)
+        ok_(fluxes['Iterations'] <= 5 + 2*1 + 2)
+
     def test_eigenvalue(self):
         source = np.zeros((self.fissionop.num_groups, self.fissionop.num_elts))
         fluxes = self.fissolv.solve(source, eigenvalue=True)